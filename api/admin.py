@@ -1,10 +1,40 @@
+from django.conf import settings
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
 from django.contrib.auth.models import User
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Exists, OuterRef
+from django.utils.functional import cached_property
 
+from .export import count_of
 from .models import *
 
 
+class EstimatedCountPaginator(Paginator):
+    """Takes PostgreSQL's row estimate instead of COUNT(*) for unfiltered changelists of tables with at least
+    ADMIN_ESTIMATED_COUNT_MIN rows; filtered and smaller changelists are counted exactly.
+    """
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        connection = connections[queryset.db]
+        if connection.vendor == 'postgresql' and not queryset.query.where:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT reltuples FROM pg_class WHERE oid = %s::regclass', [queryset.model._meta.db_table])
+                row = cursor.fetchone()
+            if row and row[0] >= settings.ADMIN_ESTIMATED_COUNT_MIN:
+                return int(row[0])
+        return super().count
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    """Changelist without exact counts of large tables (see EstimatedCountPaginator) or the extra unfiltered total."""
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+
 class UserProfileInlineAdmin(admin.StackedInline):
     model = UserProfile
 
@@ -31,9 +61,28 @@ class UserAdmin(BaseUserAdmin):
 
 
 class TermAdmin(admin.ModelAdmin):
-    list_display = ('name', 'code', 'start_date', 'end_date', 'subjects_total_count', 'subjects_active_count', 'courses_total_count', 'is_active', 'subjects_loaded')
-    fields = ('name', 'code', 'start_date', 'end_date', 'is_active', 'subjects_loaded')
-    readonly_fields = ('name', 'code', 'start_date', 'end_date', 'is_active')
+    list_display = ('name', 'code', 'start_date', 'end_date', 'subjects_total_count', 'subjects_active_count', 'courses_total_count', 'is_active', 'subjects_loaded', 'retired')
+    fields = ('name', 'code', 'start_date', 'end_date', 'is_active', 'subjects_loaded', 'retired')
+    readonly_fields = ('name', 'code', 'start_date', 'end_date', 'is_active', 'retired')
+
+    def get_queryset(self, request):
+        active_courses = Course.objects.filter(subject=OuterRef('pk'), is_cancelled=False)
+        active_subjects = Subject.objects.annotate(has_courses=Exists(active_courses)).filter(has_courses=True)
+        return super().get_queryset(request).annotate(
+            _subjects_total_count=count_of(Subject, 'term'),
+            _subjects_active_count=count_of(active_subjects, 'term'),
+            _courses_total_count=count_of(Course, 'subject__term'))
+
+    def subjects_total_count(self, obj):
+        return obj._subjects_total_count
+    subjects_total_count.admin_order_field = '_subjects_total_count'
+
+    def subjects_active_count(self, obj):
+        return obj._subjects_active_count if obj.is_active else 0
+
+    def courses_total_count(self, obj):
+        return obj._courses_total_count
+    courses_total_count.admin_order_field = '_courses_total_count'
 
     def has_add_permission(self, request):
         return False
@@ -50,6 +99,19 @@ class SubjectAdmin(admin.ModelAdmin):
     fields = ('name', 'code', 'term', 'is_active', 'courses_loaded')
     readonly_fields = ('name', 'code', 'term', 'is_active')
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).annotate(
+            _courses_total_count=count_of(Course, 'subject'),
+            _has_active_courses=Exists(Course.objects.filter(subject=OuterRef('pk'), is_cancelled=False)))
+
+    def courses_total_count(self, obj):
+        return obj._courses_total_count
+    courses_total_count.admin_order_field = '_courses_total_count'
+
+    def is_active(self, obj):
+        return obj.term.is_active and obj._has_active_courses
+    is_active.boolean = True
+
     def has_add_permission(self, request):
         return False
 
@@ -67,16 +129,28 @@ class SectionAdmin(admin.ModelAdmin):
         return False
 
 
-class CourseAdmin(admin.ModelAdmin):
+class CourseAdmin(LargeTableAdmin):
     list_display = ('__str__', 'name', 'subject', 'sections_count', 'members_count', 'is_cancelled')
     list_select_related = ('subject',)
-    list_filter = ('is_cancelled', 'subject__term', 'subject__code')
+    list_filter = ('is_cancelled', 'retired', 'subject__term')
     search_fields = ('name', 'subject__term__name', 'subject__name', 'subject__code', 'course_number')
-    fields = ('name', 'subject', 'course_number', 'sections', 'is_cancelled', 'members')
-    readonly_fields = ('name', 'subject', 'course_number', 'sections', 'is_cancelled')
-    filter_horizontal = ('members',)
+    fields = ('name', 'subject', 'course_number', 'sections', 'is_cancelled', 'retired', 'members')
+    readonly_fields = ('name', 'subject', 'course_number', 'sections', 'is_cancelled', 'retired')
+    raw_id_fields = ('members',)
     inlines = (MeetingTimeInlineAdmin,)
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).annotate(_sections_count=count_of(Course.sections.through, 'course'),
+                                                      _members_count=count_of(Course.members.through, 'course'))
+
+    def sections_count(self, obj):
+        return obj._sections_count
+    sections_count.admin_order_field = '_sections_count'
+
+    def members_count(self, obj):
+        return obj._members_count
+    members_count.admin_order_field = '_members_count'
+
     def has_add_permission(self, request):
         return False
 
@@ -84,48 +158,62 @@ class CourseAdmin(admin.ModelAdmin):
         return False
 
 
-class GroupAdmin(admin.ModelAdmin):
+class GroupAdmin(LargeTableAdmin):
     list_display = ('name', 'course', 'creator', 'members_count')
-    list_select_related = ('course',)
-    list_filter = ('course',)
+    list_select_related = ('course__subject', 'creator')
+    list_filter = ('retired', 'course__subject__term')
     search_fields = ('name', 'course__name', 'course__subject__term__name', 'course__subject__name', 'course__subject__code', 'course__course_number', 'members__first_name', 'members__last_name')
-    readonly_fields = ('course', 'creator')
-    filter_horizontal = ('members',)
+    readonly_fields = ('course', 'creator', 'retired')
+    raw_id_fields = ('members',)
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).annotate(_members_count=count_of(Group.members.through, 'group'))
 
-class MeetingAdmin(admin.ModelAdmin):
+    def members_count(self, obj):
+        return obj._members_count
+    members_count.admin_order_field = '_members_count'
+
+
+class MeetingAdmin(LargeTableAdmin):
     list_display = ('name', 'location', 'description', 'start_date', 'start_time', 'duration_minutes', 'course', 'creator', 'members_count')
-    list_select_related = ('course',)
-    list_filter = ('course', 'creator', 'location', 'start_date', 'start_time', 'duration_minutes')
+    list_select_related = ('course__subject', 'creator')
+    list_filter = ('retired', 'start_date', 'course__subject__term')
     search_fields = ('name', 'location', 'course__name', 'course__subject__term__name', 'course__subject__name', 'course__subject__code', 'course__course_number', 'members__first_name', 'members__last_name')
-    readonly_fields = ('course', 'creator')
-    filter_horizontal = ('members',)
+    readonly_fields = ('course', 'creator', 'retired')
+    raw_id_fields = ('members',)
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).annotate(_members_count=count_of(Meeting.members.through, 'meeting'))
+
+    def members_count(self, obj):
+        return obj._members_count
+    members_count.admin_order_field = '_members_count'
 
 
-class GroupInvitationAdmin(admin.ModelAdmin):
+class GroupInvitationAdmin(LargeTableAdmin):
     list_display = ('group', 'creator', 'timestamp')
-    list_select_related = ('group', 'creator')
-    list_filter = ('timestamp', 'group')
+    list_select_related = ('group__course__subject', 'creator')
+    list_filter = ('timestamp',)
     readonly_fields = ('group', 'creator', 'recipients', 'timestamp')
 
     def has_delete_permission(self, request, obj=None):
         return False
 
 
-class MeetingInvitationAdmin(admin.ModelAdmin):
+class MeetingInvitationAdmin(LargeTableAdmin):
     list_display = ('meeting', 'creator', 'timestamp')
-    list_select_related = ('meeting', 'creator')
-    list_filter = ('timestamp', 'meeting')
+    list_select_related = ('meeting__course__subject', 'creator')
+    list_filter = ('timestamp',)
     readonly_fields = ('meeting', 'creator', 'recipients', 'timestamp')
 
     def has_delete_permission(self, request, obj=None):
         return False
 
 
-class CourseMessageAdmin(admin.ModelAdmin):
+class CourseMessageAdmin(LargeTableAdmin):
     list_display = ('content', 'creator', 'course', 'timestamp')
-    list_select_related = ('course', 'creator')
-    list_filter = ('timestamp', 'course')
+    list_select_related = ('course__subject', 'creator')
+    list_filter = ('timestamp',)
     search_fields = ('content', 'creator__first_name', 'creator__last_name', 'creator__username', 'course__name', 'course__subject__term__name', 'course__subject__name', 'course__subject__code', 'course__course_number')
     readonly_fields = ('content', 'creator', 'course', 'timestamp')
 
@@ -133,10 +221,10 @@ class CourseMessageAdmin(admin.ModelAdmin):
         return False
 
 
-class GroupMessageAdmin(admin.ModelAdmin):
+class GroupMessageAdmin(LargeTableAdmin):
     list_display = ('content', 'creator', 'group', 'timestamp')
-    list_select_related = ('group', 'creator')
-    list_filter = ('timestamp', 'group', 'group__course')
+    list_select_related = ('group__course__subject', 'creator')
+    list_filter = ('timestamp',)
     search_fields = ('content', 'creator__first_name', 'creator__last_name', 'creator__username', 'group__name', 'group__course__name', 'group__course__subject__term__name', 'group__course__subject__name', 'group__course__subject__code', 'group__course__course_number')
     readonly_fields = ('content', 'creator', 'group', 'timestamp')
 
@@ -1,5 +1,21 @@
 from django.apps import AppConfig
+from django.core.signals import request_finished, request_started
+from django.db.backends.signals import connection_created
+from django.db.models.signals import m2m_changed
 
 
 class ApiConfig(AppConfig):
     name = 'api'
+
+    def ready(self):
+        from .db import check_connections, configure_sqlite, count_queries
+        request_started.connect(check_connections)
+        connection_created.connect(configure_sqlite)
+        connection_created.connect(count_queries)
+
+        from .log import clear_request_id
+        request_finished.connect(clear_request_id)
+
+        from .membership import MEMBERSHIPS, clear_member_ids
+        for through, column in MEMBERSHIPS.values():
+            m2m_changed.connect(clear_member_ids, sender=through)
@@ -0,0 +1,104 @@
+import random
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+from django.db.backends.utils import CursorDebugWrapper, CursorWrapper
+
+
+def check_connections(**kwargs):
+    """Closes persistent connections that went stale between requests, so the request opens a fresh one.
+
+    Only applies to databases with CONN_HEALTH_CHECKS set in their settings.
+    """
+    for conn in connections.all():
+        if conn.connection is not None and conn.settings_dict.get('CONN_HEALTH_CHECKS') and not conn.is_usable():
+            conn.close()
+
+
+def configure_sqlite(sender, connection, **kwargs):
+    """Applies settings.SQLITE_PRAGMAS to every new SQLite connection."""
+    if connection.vendor == 'sqlite':
+        cursor = connection.cursor()
+        for pragma, value in settings.SQLITE_PRAGMAS.items():
+            cursor.execute('PRAGMA %s = %s' % (pragma, value))
+
+
+# ~~~~~~~~ Query Counting ~~~~~~~~ #
+
+
+_queries = threading.local()
+
+
+def query_count():
+    """Queries run on the current thread so far, over all connections (see count_queries)."""
+    return getattr(_queries, 'count', 0)
+
+
+class CountingMixin(object):
+
+    def execute(self, sql, params=None):
+        _queries.count = getattr(_queries, 'count', 0) + 1
+        return super().execute(sql, params)
+
+    def executemany(self, sql, param_list):
+        _queries.count = getattr(_queries, 'count', 0) + 1
+        return super().executemany(sql, param_list)
+
+
+class CountingCursorWrapper(CountingMixin, CursorWrapper):
+    pass
+
+
+class CountingCursorDebugWrapper(CountingMixin, CursorDebugWrapper):
+    pass
+
+
+def count_queries(sender, connection, **kwargs):
+    """Makes the new connection's cursors count their queries for query_count(), at the cost of one increment each."""
+    connection.make_cursor = lambda cursor: CountingCursorWrapper(cursor, connection)
+    connection.make_debug_cursor = lambda cursor: CountingCursorDebugWrapper(cursor, connection)
+
+
+# ~~~~~~~~ Read Replicas ~~~~~~~~ #
+
+
+_state = threading.local()
+
+
+def use_replicas(enabled):
+    """Lets reads on the current thread go to settings.DATABASE_REPLICAS (set per request by ReplicaReadMixin)."""
+    _state.use_replicas = enabled
+
+
+def pin_to_primary(user):
+    """Sends the user's reads to the primary for REPLICA_PIN_SECONDS after a write, so they see their own changes.
+
+    The pin is kept in the default cache, which settings require to be shared between workers when replicas are set.
+    """
+    if settings.DATABASE_REPLICAS:
+        cache.set('primary_pin:%d' % user.pk, True, settings.REPLICA_PIN_SECONDS)
+
+
+def is_pinned_to_primary(user):
+    return user.is_authenticated() and cache.get('primary_pin:%d' % user.pk, False)
+
+
+def read_alias():
+    """A replica (or the primary without replicas) for reads that run outside the request, like streamed exports."""
+    return random.choice(settings.DATABASE_REPLICAS) if settings.DATABASE_REPLICAS else 'default'
+
+
+class ReplicaRouter(object):
+
+    def db_for_read(self, model, **hints):
+        if settings.DATABASE_REPLICAS and getattr(_state, 'use_replicas', False):
+            return random.choice(settings.DATABASE_REPLICAS)
+        return None
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True  # replicas hold the same data as the primary
@@ -0,0 +1,109 @@
+import csv
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Count, IntegerField, OuterRef, QuerySet, Subquery
+from django.db.models.functions import Coalesce
+
+from .models import *
+
+FORMATS = {  # output format: content type
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+
+def count_of(rows, field):
+    """Number of `rows` (a model or queryset) whose `field` points at the outer row, as a correlated subquery.
+
+    Unlike Count() annotations this needs no GROUP BY over the outer query, and is only evaluated for the rows returned.
+    """
+    queryset = rows if isinstance(rows, QuerySet) else rows.objects.all()
+    counts = queryset.filter(**{field: OuterRef('pk')}).order_by().values(field).annotate(n=Count('*')).values('n')
+    return Coalesce(Subquery(counts, output_field=IntegerField()), 0)
+
+
+def notification_counts():
+    return {'recipient_count': count_of(Notification.recipients.through, 'notification')}
+
+
+# name: (model, extra columns computed per row)
+EXPORTS = OrderedDict([
+    ('courses', (Course, lambda: {'member_count': count_of(Course.members.through, 'course'),
+                                  'group_count': count_of(Group, 'course'),
+                                  'meeting_count': count_of(Meeting, 'course'),
+                                  'message_count': count_of(CourseMessage, 'course')})),
+    ('groups', (Group, lambda: {'member_count': count_of(Group.members.through, 'group'),
+                                'message_count': count_of(GroupMessage, 'group')})),
+    ('meetings', (Meeting, lambda: {'member_count': count_of(Meeting.members.through, 'meeting')})),
+    ('course-messages', (CourseMessage, dict)),
+    ('group-messages', (GroupMessage, dict)),
+    ('archived-course-messages', (ArchivedCourseMessage, dict)),
+    ('archived-group-messages', (ArchivedGroupMessage, dict)),
+    ('standard-notifications', (StandardNotification, notification_counts)),
+    ('group-notifications', (GroupNotification, notification_counts)),
+    ('group-invitations', (GroupInvitation, notification_counts)),
+    ('meeting-notifications', (MeetingNotification, notification_counts)),
+    ('meeting-invitations', (MeetingInvitation, notification_counts)),
+    ('meeting-proposals', (MeetingProposal, notification_counts)),
+    ('meeting-proposal-results', (MeetingProposalResult, notification_counts)),
+])
+
+
+class Echo(object):
+    """File-like object that hands back what csv.writer writes instead of storing it."""
+
+    def write(self, value):
+        return value
+
+
+def export_columns(name):
+    model, extra = EXPORTS[name]
+    columns = [f.attname for f in model._meta.concrete_fields if not (f.primary_key and f.remote_field)]  # no *_ptr_id
+    return columns + list(extra())
+
+
+def export_rows(name, using='default', chunk_size=None):
+    """Yields the rows of export `name` as tuples (in export_columns order), in pk order.
+
+    Rows are fetched chunk_size at a time by keyset pagination (pk > last pk), so memory stays bounded without relying on
+    server-side cursors, which are disabled behind pgbouncer. Each chunk is its own short query.
+    """
+    model, extra = EXPORTS[name]
+    chunk_size = chunk_size or settings.EXPORT_CHUNK_SIZE
+    columns = export_columns(name)
+    queryset = model.objects.using(using).annotate(**extra()).order_by('pk').values_list(*columns)
+    last_pk = None
+    while True:
+        chunk = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+        rows = list(chunk[:chunk_size])
+        yield from rows
+        if len(rows) < chunk_size:
+            return
+        last_pk = rows[-1][0]
+
+
+def export_lines(name, output_format='ndjson', using='default', chunk_size=None):
+    """Yields export `name` encoded as NDJSON or CSV (with a header line), one string per chunk of rows.
+
+    Lines are yielded in chunks rather than one by one so that gzip (which flushes per yielded item when streaming) and
+    the socket get reasonably sized writes.
+    """
+    chunk_size = chunk_size or settings.EXPORT_CHUNK_SIZE
+    columns = export_columns(name)
+    encoder = DjangoJSONEncoder(separators=(',', ':'))
+    if output_format == 'csv':  # dates and times formatted like in the JSON
+        writer = csv.writer(Echo())
+        encode = lambda row: writer.writerow([encoder.default(value) if hasattr(value, 'isoformat') else value for value in row])
+        lines = [encode(columns)]
+    else:
+        encode = lambda row: encoder.encode(OrderedDict(zip(columns, row))) + '\n'
+        lines = []
+    for row in export_rows(name, using, chunk_size):
+        lines.append(encode(row))
+        if len(lines) >= chunk_size:
+            yield ''.join(lines)
+            lines = []
+    if lines:
+        yield ''.join(lines)
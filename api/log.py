@@ -0,0 +1,147 @@
+"""Logging that stays off the request path: records are queued to a listener thread that formats them as JSON and
+writes them, so a request never waits on the console or the log file.
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import re
+import sys
+import threading
+import uuid
+from datetime import datetime, timezone
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.module_loading import import_string
+
+_state = threading.local()  # request_id of the request being handled on this thread
+
+REQUEST_ID_PATTERN = re.compile(r'^[\w.:-]{1,64}$')
+
+# attributes every LogRecord has; any other attribute came from `extra` and is written as a field of its own
+RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'request_id'}
+
+
+def request_id():
+    return getattr(_state, 'request_id', None)
+
+
+def set_request_id(value):
+    """Sets the id of the request handled on this thread: `value` if it looks like an id (e.g. a proxy's
+    X-Request-ID), else a new one. Returns the id; None clears it.
+    """
+    if value is not None and not REQUEST_ID_PATTERN.match(value):
+        value = uuid.uuid4().hex
+    _state.request_id = value
+    return value
+
+
+def clear_request_id(**kwargs):
+    """request_finished receiver: the thread is done with the request."""
+    _state.request_id = None
+
+
+class RequestIdFilter(logging.Filter):
+    """Adds the current request's id to records; must run on the thread that logs (i.e. on the QueueHandler)."""
+
+    def filter(self, record):
+        record.request_id = request_id()
+        return True
+
+
+class LogEncoder(DjangoJSONEncoder):
+
+    def default(self, o):
+        try:
+            return super().default(o)
+        except TypeError:
+            return repr(o)
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per record: time, level, logger, message, request_id, the `extra` fields and the traceback."""
+
+    def format(self, record):
+        data = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'request_id': getattr(record, 'request_id', None),
+        }
+        data.update((key, value) for key, value in vars(record).items() if key not in RECORD_ATTRIBUTES)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exception'] = record.exc_text
+        if record.stack_info:
+            data['stack'] = record.stack_info
+        return json.dumps(data, cls=LogEncoder, separators=(',', ':'))
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    """Puts records on a queue served by a listener thread that passes them to the `targets` handlers, which do the
+    JSON formatting and the I/O. Each target is a dict like a LOGGING handler: `class`, optional `level`, and the
+    class's arguments.
+
+    The listener and its targets are created with the first record of each process, so gunicorn workers forked from a
+    preloaded master get their own, and the listener is stopped (draining the queue) at exit. When the queue is full,
+    records are dropped and counted rather than blocking the caller.
+    """
+
+    def __init__(self, targets=(), maxsize=10000):
+        super().__init__(queue.Queue(maxsize))
+        self.targets = [dict(target) for target in targets]
+        self.maxsize = maxsize
+        self.listener = None
+        self.pid = None
+        self.dropped = 0
+        self.start_lock = threading.Lock()
+
+    def start(self):
+        with self.start_lock:
+            if self.pid == os.getpid():
+                return
+            handlers = []
+            for target in self.targets:
+                kwargs = dict(target)
+                level = kwargs.pop('level', logging.NOTSET)
+                handler = import_string(kwargs.pop('class'))(**kwargs)
+                handler.setLevel(level)
+                handler.setFormatter(JSONFormatter())
+                handlers.append(handler)
+            self.queue = queue.Queue(self.maxsize)  # a fresh queue: the parent's may have been forked mid-put
+            self.listener = logging.handlers.QueueListener(self.queue, *handlers, respect_handler_level=True)
+            self.listener.start()
+            self.pid = os.getpid()
+            atexit.register(self.stop)
+
+    def stop(self):
+        """Drains the queue and stops this process's listener; a no-op if it is not running."""
+        with self.start_lock:
+            if self.listener is not None and self.pid == os.getpid():
+                self.listener.stop()
+                self.listener = None
+                self.pid = None
+
+    def prepare(self, record):
+        """Resolves the message and traceback on the logging thread (args may change later), keeping `extra` fields."""
+        record.message = record.getMessage()
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.msg = record.message
+        record.args = None
+        record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        if self.pid != os.getpid():
+            self.start()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            if self.dropped % 1000 == 1:
+                sys.stderr.write('api.log: queue full, ' + str(self.dropped) + ' records dropped\n')
@@ -0,0 +1,31 @@
+import time
+from datetime import date, timedelta
+from timeit import default_timer as timer
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from api.models import *
+
+
+class Command(BaseCommand):
+    help = 'Moves the course and group messages of terms that ended MESSAGE_ARCHIVE_DAYS ago to the archive tables'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.MESSAGE_ARCHIVE_DAYS, help='Days after the end of a term')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Messages moved per transaction')
+        parser.add_argument('--interval', type=int, default=0, help='Seconds between runs; runs once if 0')
+
+    def handle(self, *args, **options):
+        interval = options['interval']
+        while True:
+            start_timer = timer()
+            moved = 0
+            for term in Term.objects.filter(end_date__lt=date.today() - timedelta(days=options['days'])):
+                moved += term.archive_messages(options['batch_size'])
+            end_timer = timer()
+            if moved or not interval:
+                self.stdout.write(self.style.SUCCESS('Archived ' + str(moved) + ' messages in ' + str(round(end_timer - start_timer, 2)) + ' seconds'))
+            if not interval:
+                break
+            time.sleep(interval)
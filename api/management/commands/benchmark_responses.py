@@ -0,0 +1,49 @@
+from timeit import default_timer as timer
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.text import compress_string
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+
+from api.middleware import BROTLI_QUALITY, brotli
+from api.renderers import FastJSONRenderer, orjson
+
+ENDPOINTS = ('/api/courses/', '/api/course-messages/', '/api/group-messages/', '/api/users/', '/api/subjects/')
+
+
+class Command(BaseCommand):
+    help = 'Compares JSON render time and bytes on the wire (plain, gzip, brotli) for the largest endpoints'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def handle(self, *args, **options):
+        user = User.objects.filter(is_staff=True).first() or User.objects.first()
+        if not user:
+            raise CommandError('need at least one user (see populate_data)')
+        client = APIClient()
+        client.force_authenticate(user)
+        if orjson is None:
+            self.stdout.write(self.style.NOTICE('orjson is not installed; FastJSONRenderer uses the stdlib encoder'))
+
+        for url in ENDPOINTS:
+            data = client.get(url, HTTP_ACCEPT='application/json').data
+            content = JSONRenderer().render(data)
+            if FastJSONRenderer().render(data) != content:
+                raise CommandError(url + ': FastJSONRenderer output differs from JSONRenderer')
+
+            self.stdout.write(self.style.NOTICE(url))
+            self.stdout.write(self.style.SUCCESS('    render: ' + self.render_time(JSONRenderer(), data, options['repeat']) + ' ms (stdlib), '
+                                                 + self.render_time(FastJSONRenderer(), data, options['repeat']) + ' ms (fast)'))
+            sizes = str(len(content)) + ' bytes, gzip ' + str(len(compress_string(content)))
+            if brotli is not None:
+                sizes += ', brotli ' + str(len(brotli.compress(content, quality=BROTLI_QUALITY)))
+            self.stdout.write(self.style.SUCCESS('    size: ' + sizes))
+
+    def render_time(self, renderer, data, repeat):
+        start_timer = timer()
+        for _ in range(repeat):
+            renderer.render(data)
+        end_timer = timer()
+        return str(round((end_timer - start_timer) * 1000 / repeat, 2))
@@ -0,0 +1,55 @@
+from timeit import default_timer as timer
+
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.renderers import JSONRenderer
+
+from api.serializers import *
+from api.views import optimize_queryset
+
+BENCHMARKS = (
+    ('terms', TermSerializer, TermFastSerializer),
+    ('subjects', SubjectSerializer, SubjectFastSerializer),
+    ('courses', CourseSerializer, CourseFastSerializer),
+    ('course messages', CourseMessageSerializer, CourseMessageFastSerializer),
+    ('group messages', GroupMessageSerializer, GroupMessageFastSerializer),
+)
+
+
+class Command(BaseCommand):
+    help = 'Checks that the fast list serializers match the regular ones and compares their rows/second'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=1000, help='Rows per list (like one page of PAGE_SIZE rows)')
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        renderer = JSONRenderer()
+        for name, serializer_class, fast_serializer_class in BENCHMARKS:
+            queryset = serializer_class.Meta.model.objects.all()[:options['rows']]
+
+            def regular():
+                return serializer_class(optimize_queryset(queryset, serializer_class()), many=True).data
+
+            def fast():
+                fast_serializer = fast_serializer_class()
+                return fast_serializer.serialize(fast_serializer.prepare(queryset))
+
+            expected, actual = regular(), fast()
+            if renderer.render(expected) != renderer.render(actual):
+                raise CommandError(name + ': fast serializer output differs from ' + serializer_class.__name__)
+            if not expected:
+                self.stdout.write(self.style.NOTICE(name + ': no rows (see populate_data)'))
+                continue
+
+            regular_rate = self.rate(regular, len(expected), options['repeat'])
+            fast_rate = self.rate(fast, len(expected), options['repeat'])
+            self.stdout.write(self.style.NOTICE(name + ': ' + str(len(expected)) + ' rows, output identical'))
+            self.stdout.write(self.style.SUCCESS('    regular: ' + str(int(regular_rate)) + ' rows/second'))
+            self.stdout.write(self.style.SUCCESS('    fast: ' + str(int(fast_rate)) + ' rows/second (' + str(round(fast_rate / regular_rate, 1)) + 'x)'))
+
+    def rate(self, serialize, rows, repeat):
+        start_timer = timer()
+        for _ in range(repeat):
+            serialize()
+        end_timer = timer()
+        return rows * repeat / (end_timer - start_timer)
@@ -0,0 +1,65 @@
+import threading
+from timeit import default_timer as timer
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, OperationalError
+from django.test.utils import override_settings
+
+from api.models import *
+
+BENCHMARK_CONTENT = 'benchmark_writes message'
+
+
+class Command(BaseCommand):
+    help = 'Measures course message post throughput with concurrent writers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8)
+        parser.add_argument('--seconds', type=float, default=10)
+        parser.add_argument('--baseline', action='store_true', help='Use SQLite default pragmas instead of SQLITE_PRAGMAS')
+
+    def handle(self, *args, **options):
+        course = Course.objects.first()
+        user = User.objects.first()
+        if not course or not user:
+            raise CommandError('need at least one course and one user (see populate_data)')
+
+        if options['baseline']:
+            with override_settings(SQLITE_PRAGMAS={}):
+                if connection.vendor == 'sqlite':
+                    connection.close()
+                    connection.cursor().execute('PRAGMA journal_mode = DELETE')
+                posts, errors, elapsed = self.run(course, user, options['threads'], options['seconds'])
+        else:
+            connection.close()  # reopen with SQLITE_PRAGMAS applied
+            posts, errors, elapsed = self.run(course, user, options['threads'], options['seconds'])
+
+        CourseMessage.objects.filter(content=BENCHMARK_CONTENT).delete()
+        self.stdout.write(self.style.NOTICE(str(options['threads']) + ' threads: ' + str(posts) + ' posts in ' + str(elapsed) + ' seconds'))
+        self.stdout.write(self.style.NOTICE('"database is locked" errors: ' + str(errors)))
+        self.stdout.write(self.style.SUCCESS(str(posts / elapsed) + ' posts/second'))
+
+    def run(self, course, user, threads, seconds):
+        counts = []
+        deadline = timer() + seconds
+
+        def post():
+            posts = errors = 0
+            while timer() < deadline:
+                try:
+                    CourseMessage.objects.create(content=BENCHMARK_CONTENT, course=course, creator=user)
+                    posts += 1
+                except OperationalError:
+                    errors += 1
+            connection.close()
+            counts.append((posts, errors))
+
+        start_timer = timer()
+        workers = [threading.Thread(target=post) for _ in range(threads)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        end_timer = timer()
+        return sum(c[0] for c in counts), sum(c[1] for c in counts), end_timer - start_timer
@@ -0,0 +1,22 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from api.models import *
+
+
+class Command(BaseCommand):
+    help = 'Closes expired meeting proposals and sends their results'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=int, default=0, help='Seconds between sweeps; runs once if 0')
+
+    def handle(self, *args, **options):
+        interval = options['interval']
+        while True:
+            results = MeetingProposal.close_expired()
+            if results or not interval:
+                self.stdout.write(self.style.SUCCESS('Closed ' + str(len(results)) + ' expired meeting proposals'))
+            if not interval:
+                break
+            time.sleep(interval)
@@ -0,0 +1,22 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from api.models import *
+
+
+class Command(BaseCommand):
+    help = 'Drops superseded change log entries and tombstones older than SYNC_TOMBSTONE_DAYS'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=int, default=0, help='Seconds between compactions; runs once if 0')
+
+    def handle(self, *args, **options):
+        interval = options['interval']
+        while True:
+            removed = ChangeLogEntry.compact()
+            if removed or not interval:
+                self.stdout.write(self.style.SUCCESS('Removed ' + str(removed) + ' change log entries'))
+            if not interval:
+                break
+            time.sleep(interval)
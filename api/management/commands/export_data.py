@@ -0,0 +1,35 @@
+from timeit import default_timer as timer
+
+from django.core.management.base import BaseCommand
+
+from api.db import read_alias
+from api.export import EXPORTS, FORMATS, export_lines
+
+
+class Command(BaseCommand):
+    help = 'Writes a whole table as NDJSON or CSV, a chunk of rows at a time (same output as /api/export/<name>/)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('name', choices=list(EXPORTS))
+        parser.add_argument('--format', choices=sorted(FORMATS), default='ndjson')
+        parser.add_argument('--output', help='File to write to; stdout if omitted')
+        parser.add_argument('--chunk-size', type=int, help='Rows per query (default: settings.EXPORT_CHUNK_SIZE)')
+
+    def handle(self, *args, **options):
+        start_timer = timer()
+        out = open(options['output'], 'w', newline='') if options['output'] else None
+        size = 0
+        try:
+            for chunk in export_lines(options['name'], options['format'], using=read_alias(), chunk_size=options['chunk_size']):
+                if out:
+                    out.write(chunk)
+                else:
+                    self.stdout.write(chunk, ending='')
+                size += len(chunk)
+        finally:
+            if out:
+                out.close()
+        end_timer = timer()
+        if options['output']:
+            self.stdout.write(self.style.SUCCESS('Exported ' + options['name'] + ' (' + str(size) + ' characters) to ' + options['output']
+                                                 + ' in ' + str(round(end_timer - start_timer, 2)) + ' seconds'))
@@ -0,0 +1,22 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from api.models import *
+
+
+class Command(BaseCommand):
+    help = 'Sends queued push notifications, merging several per user into one digest'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=int, default=0, help='Seconds between flushes; runs once if 0')
+
+    def handle(self, *args, **options):
+        interval = options['interval']
+        while True:
+            count = QueuedPush.flush()
+            if count or not interval:
+                self.stdout.write(self.style.SUCCESS('Sent queued pushes to ' + str(count) + ' users'))
+            if not interval:
+                break
+            time.sleep(interval)
@@ -1,9 +1,11 @@
 import datetime
 import json
+from timeit import default_timer as timer
 
 import requests
 from django.core.management.base import BaseCommand, CommandError
 
+from api.metrics import LOAD_COURSES_ROWS, LOAD_COURSES_SUBJECT_DURATION
 from api.models import *
 
 
@@ -70,8 +72,9 @@ class Command(BaseCommand):
         server_state.save()
 
         # Courses
-        Course.objects.all().update(is_cancelled=True)  # TODO: incativates any courses that might have been removed from the coursecatalog
+        Course.objects.filter(subject__term=t).update(is_cancelled=True)  # inactivates any of this term's courses that were removed from the coursecatalog
         for s in t.subjects.all():
+            subject_start = timer()
             r = requests.get('https://m.gatech.edu/api/coursecatalog/term/' + t.code + '/classes?Subject=' + s.code + '&jwt=' + server_data.get_jwt())
             try:
                 courses_json = json.loads(r.text)
@@ -81,6 +84,7 @@ class Command(BaseCommand):
                 self.stdout.write(self.style.WARNING(s.code + ': error loading courses'))
                 continue
             if courses_json:
+                meeting_time_count = 0
                 for course_json in courses_json:
                     name = course_json['course_title']
                     course_number = course_json['course_number']
@@ -118,9 +122,13 @@ class Command(BaseCommand):
                             if end_time:
                                 mt.end_time = end_time[:2] + ':' + end_time[2:]
                             mt.save()
+                            meeting_time_count += 1
                     self.stdout.write(self.style.SUCCESS(s.code + ': ' + str(s.courses.filter(is_cancelled=False).count()) + ' courses'))
                 s.courses_loaded = True
                 s.save()
+                LOAD_COURSES_ROWS.inc(len(courses_json), table='course')
+                LOAD_COURSES_ROWS.inc(meeting_time_count, table='meeting_time')
+            LOAD_COURSES_SUBJECT_DURATION.observe(timer() - subject_start)
         server_state.courses_status = ServerState.LOADED
         server_state.save()
 
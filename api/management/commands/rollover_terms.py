@@ -0,0 +1,27 @@
+from datetime import date
+from timeit import default_timer as timer
+
+from django.core.management.base import BaseCommand
+
+from api.models import *
+
+
+class Command(BaseCommand):
+    help = 'Retires the courses, groups and meetings of terms past their end_date, so they drop out of the default lists'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Rows updated per transaction')
+
+    def handle(self, *args, **options):
+        start_timer = timer()
+        total = 0
+        for term in Term.objects.filter(end_date__lt=date.today()):  # retired terms too, for rows added since
+            progress = {}
+
+            def report(model, count):
+                progress[model] = progress.get(model, 0) + count
+                self.stdout.write(self.style.NOTICE(term.name + ': ' + str(progress[model]) + ' ' + str(model._meta.verbose_name_plural) + ' retired'))
+
+            total += term.retire(options['batch_size'], report)
+        end_timer = timer()
+        self.stdout.write(self.style.SUCCESS('Retired ' + str(total) + ' rows in ' + str(round(end_timer - start_timer, 2)) + ' seconds'))
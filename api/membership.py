@@ -0,0 +1,110 @@
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import CharField, Value
+
+from .metrics import CACHE_REQUESTS
+from .models import Course, Group, Meeting
+
+# kind: (through model, column holding the course/group/meeting id)
+MEMBERSHIPS = {
+    'courses': (Course.members.through, 'course_id'),
+    'groups': (Group.members.through, 'group_id'),
+    'meetings': (Meeting.members.through, 'meeting_id'),
+}
+
+_state = threading.local()  # generation: bumped whenever a membership changes on this thread
+
+
+def cache_key(kind, user_id):
+    return 'member_ids:%s:%d' % (kind, user_id)
+
+
+def query_member_ids(user):
+    """{kind: frozenset of ids} of the courses, groups and meetings the user is a member of.
+
+    All three sets come from one UNION over the user's through-table rows, which the (user_id, ...) covering indexes
+    answer from the index alone.
+    """
+    queries = [through.objects.filter(user_id=user.pk).annotate(kind=Value(kind, output_field=CharField())).values_list(column, 'kind')
+               for kind, (through, column) in MEMBERSHIPS.items()]
+    ids = {kind: set() for kind in MEMBERSHIPS}
+    for pk, kind in queries[0].union(*queries[1:], all=True):
+        ids[kind].add(pk)
+    return {kind: frozenset(pks) for kind, pks in ids.items()}
+
+
+def load_member_ids(user):
+    """query_member_ids(user), cached for MEMBERSHIP_CACHE_SECONDS when the cache is shared by all workers.
+
+    A per-process cache is never used: a join or leave only clears the sets cached by the worker that handled it, so
+    the other workers would keep authorizing against the old ones.
+    """
+    if not settings.SHARED_CACHE:
+        return query_member_ids(user)
+    keys = {kind: cache_key(kind, user.pk) for kind in MEMBERSHIPS}
+    cached = cache.get_many(list(keys.values()))
+    if len(cached) == len(keys):
+        CACHE_REQUESTS.inc(cache='member_ids', result='hit')
+        return {kind: cached[key] for kind, key in keys.items()}
+    CACHE_REQUESTS.inc(cache='member_ids', result='miss')
+    ids = query_member_ids(user)
+    cache.set_many({keys[kind]: pks for kind, pks in ids.items()}, settings.MEMBERSHIP_CACHE_SECONDS)
+    return ids
+
+
+class Membership(object):
+    """A user's membership id sets, loaded at most once per request; every check is then a set lookup.
+
+    Reloaded if a membership changed on this thread since (e.g. a join earlier in the same batch).
+    """
+
+    def __init__(self, user):
+        self.user = user
+        self.generation = None
+        self.member_ids = None
+
+    def ids(self, kind):
+        if self.user.pk is None:
+            return frozenset()
+        generation = getattr(_state, 'generation', 0)
+        if self.generation != generation:
+            self.member_ids = load_member_ids(self.user)
+            self.generation = generation
+        return self.member_ids[kind]
+
+    def has(self, kind, pk):
+        return pk in self.ids(kind)
+
+
+def membership(user):
+    """The Membership of `user`, kept on the user object (one per request; batch sub-requests share it)."""
+    if not hasattr(user, '_membership'):
+        user._membership = Membership(user)
+    return user._membership
+
+
+def member_ids(user, kind):
+    return membership(user).ids(kind)
+
+
+def clear_member_ids(sender, instance=None, action=None, reverse=False, pk_set=None, **kwargs):
+    """Drops the cached id sets of the users whose membership changed (on join, leave, members.set() etc.)."""
+    if reverse:  # user.courses_as_member.add(...)
+        if not action.startswith('post_'):
+            return
+        user_ids = [instance.pk]
+    elif action == 'pre_clear':  # the former members are unknown after the clear
+        user_ids = list(instance.members.values_list('pk', flat=True))
+    elif action in ('post_add', 'post_remove'):
+        user_ids = pk_set
+    else:
+        return
+    _state.generation = getattr(_state, 'generation', 0) + 1
+    if not settings.SHARED_CACHE:
+        return
+    keys = [cache_key(kind, user_id) for kind in MEMBERSHIPS for user_id in user_ids]
+    cache.delete_many(keys)
+    transaction.on_commit(lambda: cache.delete_many(keys))  # in case a concurrent request cached the old sets meanwhile
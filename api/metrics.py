@@ -0,0 +1,237 @@
+"""Prometheus-style metrics shared by every process (gunicorn workers, management commands).
+
+Each process keeps its values in memory; a background thread writes them to METRICS_DIR/<pid>-<id>.json every
+METRICS_FLUSH_SECONDS (and at exit), so recording a value is a dict update and never waits on I/O. /metrics adds up
+the files of all processes; files of processes that have exited are first folded into METRICS_DIR/total.json, so
+counters neither drop when a worker restarts nor accumulate one file per process ever started.
+"""
+import atexit
+import fcntl
+import glob
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, float('inf'))
+
+TOTAL_FILE = 'total.json'
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:  # exists, owned by another user
+        return True
+    return True
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.metrics = OrderedDict()
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.pid = None
+        self.path = None
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def ensure_started(self):
+        """Called (under self.lock) before each update: starts the flush thread once per process.
+
+        A process forked from one that already recorded values (e.g. a preloaded gunicorn master) starts from zero,
+        since the parent's values are in the parent's file.
+        """
+        if self.pid == os.getpid():
+            return
+        if self.pid is not None:
+            for metric in self.metrics.values():
+                metric.values.clear()
+        self.pid = os.getpid()
+        self.path = None
+        if settings.METRICS_DIR:
+            self.path = os.path.join(settings.METRICS_DIR, str(self.pid) + '-' + uuid.uuid4().hex[:8] + '.json')
+            threading.Thread(target=self.flush_loop, name='metrics-flush', daemon=True).start()
+
+    def flush_loop(self):
+        while True:
+            time.sleep(settings.METRICS_FLUSH_SECONDS)
+            self.flush()
+
+    def snapshot(self):
+        with self.lock:
+            return {name: metric.dump() for name, metric in self.metrics.items()}
+
+    def flush(self):
+        """Writes this process's values to its file (outside self.lock, from a snapshot)."""
+        path = self.path
+        if path is None or self.pid != os.getpid():
+            return
+        with self.flush_lock:
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path + '.tmp', 'w') as f:
+                    json.dump(self.snapshot(), f)
+                os.replace(path + '.tmp', path)
+            except OSError as e:  # the next flush retries
+                logger.warning('metrics flush failed: %s', e)
+
+    def add_dump(self, totals, dump):
+        for name, values in dump.items():
+            if name in self.metrics:
+                metric = self.metrics[name]
+                for labels, value in values.items():
+                    totals[name][labels] = metric.add(totals[name].get(labels), value)
+
+    def collect(self):
+        """{metric name: {label values: value}} summed over every process (or just this process without METRICS_DIR)."""
+        if not settings.METRICS_DIR:
+            return self.snapshot()
+        self.flush()
+        os.makedirs(settings.METRICS_DIR, exist_ok=True)
+        total_path = os.path.join(settings.METRICS_DIR, TOTAL_FILE)
+        pattern = os.path.join(settings.METRICS_DIR, '*-*.json')
+        with open(os.path.join(settings.METRICS_DIR, 'lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)  # one collector at a time folds files into the total
+            dead = [path for path in glob.glob(pattern) if not pid_alive(int(os.path.basename(path).split('-')[0]))]
+            if dead:  # exited processes write no more; move their values into the total
+                carried = {name: {} for name in self.metrics}
+                self.read(total_path, carried)
+                for path in dead:
+                    self.read(path, carried)
+                with open(total_path + '.tmp', 'w') as f:
+                    json.dump(carried, f)
+                os.replace(total_path + '.tmp', total_path)
+                for path in dead:
+                    os.remove(path)
+            totals = {name: {} for name in self.metrics}
+            self.read(total_path, totals)
+            for path in glob.glob(pattern):
+                self.read(path, totals)
+        return totals
+
+    def read(self, path, totals):
+        try:
+            with open(path) as f:
+                self.add_dump(totals, json.load(f))
+        except (OSError, ValueError):  # no total yet, or half-written by a crashed process
+            pass
+
+    def exposition(self):
+        """All metrics in the Prometheus text format."""
+        lines = []
+        for name, values in self.collect().items():
+            metric = self.metrics[name]
+            lines.append('# HELP ' + name + ' ' + metric.documentation)
+            lines.append('# TYPE ' + name + ' ' + metric.type)
+            for labels, value in sorted(values.items()):
+                lines.extend(metric.samples(OrderedDict(zip(metric.labelnames, json.loads(labels))), value))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+atexit.register(registry.flush)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(name + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+                          for name, value in labels.items()) + '}'
+
+
+def format_value(value):
+    return '+Inf' if value == float('inf') else repr(float(value))
+
+
+class Metric(object):
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}  # tuple of label values: value
+        registry.register(self)
+
+    def key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def dump(self):
+        return {json.dumps(labels): list(value) if isinstance(value, list) else value for labels, value in self.values.items()}
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with registry.lock:
+            registry.ensure_started()
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def add(self, total, value):
+        return (total or 0) + value
+
+    def samples(self, labels, value):
+        return [self.name + format_labels(labels) + ' ' + format_value(value)]
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with registry.lock:
+            registry.ensure_started()
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [0] * len(self.buckets) + [0.0]  # per-bucket counts, then the sum
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            counts[-1] += value
+
+    def add(self, total, value):
+        return [a + b for a, b in zip(total, value)] if total else list(value)
+
+    def samples(self, labels, value):
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, value):
+            cumulative += count
+            samples.append(self.name + '_bucket' + format_labels(OrderedDict(labels, le=format_value(bound))) + ' ' + format_value(cumulative))
+        samples.append(self.name + '_sum' + format_labels(labels) + ' ' + format_value(value[-1]))
+        samples.append(self.name + '_count' + format_labels(labels) + ' ' + format_value(cumulative))
+        return samples
+
+
+# ~~~~~~~~ Metrics ~~~~~~~~ #
+
+
+REQUEST_DURATION = Histogram('gtcollab_request_duration_seconds', 'API request latency per viewset action.', ('view', 'action', 'method', 'status'))
+DB_QUERIES = Counter('gtcollab_db_queries_total', 'Database queries run by requests, per viewset action.', ('view', 'action'))
+PUSH_SEND_DURATION = Histogram('gtcollab_push_send_duration_seconds', 'Time taken by one batched FCM request (one application, up to max_recipients tokens).')
+PUSH_MESSAGES = Counter('gtcollab_push_messages_total', 'Push messages by FCM result: sent, failed, or error when the FCM request itself failed.', ('result',))
+PUSH_RECIPIENTS = Counter('gtcollab_push_recipients_total', 'Notification recipients pushed to right away or queued for coalescing.', ('route',))
+LOAD_COURSES_SUBJECT_DURATION = Histogram('gtcollab_load_courses_subject_duration_seconds', 'Time load_courses takes per subject.',
+                                          buckets=(.5, 1, 2.5, 5, 10, 30, 60, 120, float('inf')))
+LOAD_COURSES_ROWS = Counter('gtcollab_load_courses_rows_total', 'Rows written by load_courses.', ('table',))
+CACHE_REQUESTS = Counter('gtcollab_cache_requests_total', 'Cache lookups by cache and result (hit, miss).', ('cache', 'result'))
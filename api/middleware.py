@@ -0,0 +1,221 @@
+import cProfile
+import glob
+import hmac
+import logging
+import os
+import random
+import re
+from collections import Counter
+from datetime import datetime
+from timeit import default_timer as timer
+
+from django.conf import settings
+from django.db import connections
+from django.test.utils import CaptureQueriesContext
+from django.utils.cache import patch_vary_headers
+from django.utils.deprecation import MiddlewareMixin
+from django.utils.text import compress_sequence, compress_string
+
+from .db import query_count
+from .log import set_request_id
+from .metrics import DB_QUERIES, REQUEST_DURATION
+
+try:
+    import brotli
+except ImportError:  # optional; only gzip is offered without it
+    brotli = None
+
+BROTLI_QUALITY = 4  # dynamic responses: much faster than the default 11, still smaller than gzip
+
+logger = logging.getLogger(__name__)
+
+
+def accepted_encodings(header):
+    """Content codings with a non-zero q-value in an Accept-Encoding header, best first (brotli wins ties)."""
+    encodings = []
+    for part in header.split(','):
+        coding, _, params = part.strip().partition(';')
+        q = 1.0
+        if params.strip().startswith('q='):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0
+        if coding and q > 0:
+            encodings.append((q, coding.strip().lower()))
+    return [coding for q, coding in sorted(encodings, key=lambda e: (-e[0], e[1] != 'br'))]
+
+
+class CompressionMiddleware(MiddlewareMixin):
+    """Like django's GZipMiddleware, but negotiates brotli (when installed) or gzip, and leaves responses smaller
+    than settings.COMPRESSION_MIN_SIZE bytes alone. Streaming responses are only gzipped.
+    """
+
+    def process_response(self, request, response):
+        if not response.streaming and len(response.content) < settings.COMPRESSION_MIN_SIZE:
+            return response
+        if response.has_header('Content-Encoding'):
+            return response
+
+        patch_vary_headers(response, ('Accept-Encoding',))
+
+        encoding = None
+        for coding in accepted_encodings(request.META.get('HTTP_ACCEPT_ENCODING', '')):
+            if (coding == 'br' and brotli is not None and not response.streaming) or coding == 'gzip':
+                encoding = coding
+                break
+        if encoding is None:
+            return response
+
+        if response.streaming:
+            response.streaming_content = compress_sequence(response.streaming_content)
+            del response['Content-Length']
+        else:
+            if encoding == 'br':
+                compressed_content = brotli.compress(response.content, quality=BROTLI_QUALITY)
+            else:
+                compressed_content = compress_string(response.content)
+            if len(compressed_content) >= len(response.content):
+                return response
+            response.content = compressed_content
+            response['Content-Length'] = str(len(response.content))
+
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response['ETag'] = 'W/' + etag
+        response['Content-Encoding'] = encoding
+        return response
+
+
+def fingerprint(sql):
+    """The SQL with its literals replaced by ?, so executions of the same statement with other values match."""
+    sql = re.sub(r"'(?:[^']|'')*'", '?', sql)
+    sql = re.sub(r'\b\d+(?:\.\d+)?\b', '?', sql)
+    return re.sub(r'\((?:\?, )+\?\)', '(...)', sql)
+
+
+class ProfilingMiddleware(object):
+    """Profiles a sample of requests (PROFILING_SAMPLE_RATE), and any request with an `X-Profile: <PROFILING_TOKEN>`
+    header (never without a PROFILING_TOKEN set).
+
+    Records the SQL count and time on every database, repeated statements (by fingerprint), the time spent in the view
+    outside SQL (mostly serializers), response rendering and the total (not the iteration of streamed content). The
+    result is logged to `api.middleware`; header-triggered requests also get it as a Server-Timing header.
+    `X-Profile-Dump: 1` additionally runs the request under cProfile and writes the pstats file to PROFILING_DIR
+    (readable with pstats, snakeviz or flameprof), which keeps the latest PROFILING_MAX_DUMPS files.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        requested = self.requested(request)
+        if not requested and random.random() >= settings.PROFILING_SAMPLE_RATE:
+            return self.get_response(request)
+
+        request.profile = {'view': 0.0, 'render': 0.0}
+        contexts = [CaptureQueriesContext(connection) for connection in connections.all()]
+        for context in contexts:
+            context.__enter__()
+        profiler = cProfile.Profile() if requested and request.META.get('HTTP_X_PROFILE_DUMP') == '1' else None
+        start_timer = timer()
+        try:
+            response = profiler.runcall(self.get_response, request) if profiler else self.get_response(request)
+        finally:
+            end_timer = timer()
+            for context in contexts:
+                context.__exit__(None, None, None)
+        if 'view_start' in request.profile:  # not a template response (e.g. streamed), so rendered in the view
+            request.profile['view'] = end_timer - request.profile.pop('view_start')
+
+        queries = [q for context in contexts for q in context.captured_queries]
+        sql_time = sum(float(q['time']) for q in queries)
+        repeated = [(sql, count) for sql, count in Counter(fingerprint(q['sql']) for q in queries).most_common() if count > 1]
+        timings = (
+            ('sql', sql_time * 1000, str(len(queries)) + ' queries, ' + str(len(repeated)) + ' repeated'),
+            ('app', max(request.profile['view'] - sql_time, 0) * 1000, 'view code and serializers'),
+            ('render', request.profile['render'] * 1000, 'response rendering'),
+            ('total', (end_timer - start_timer) * 1000, ''),
+        )
+        if requested:
+            response['Server-Timing'] = ', '.join(name + ';dur=' + str(round(duration, 2)) + (';desc="' + desc + '"' if desc else '')
+                                                  for name, duration, desc in timings)
+        if profiler:
+            response['X-Profile-Dump'] = self.dump(request, profiler)
+        logger.info('profile %s %s %s', request.method, request.get_full_path(),
+                    ', '.join(name + '=' + str(round(duration, 2)) + 'ms' for name, duration, desc in timings),
+                    extra={'profile': {name: round(duration, 2) for name, duration, desc in timings},
+                           'queries': len(queries), 'repeated_queries': repeated[:10]})
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if hasattr(request, 'profile'):
+            request.profile['view_start'] = timer()
+
+    def process_template_response(self, request, response):
+        if hasattr(request, 'profile'):
+            now = timer()
+            request.profile['view'] = now - request.profile.pop('view_start', now)
+            response.add_post_render_callback(lambda r: request.profile.__setitem__('render', timer() - now))
+        return response
+
+    def requested(self, request):
+        header = request.META.get('HTTP_X_PROFILE')
+        return bool(settings.PROFILING_TOKEN) and header is not None and hmac.compare_digest(header.encode(), settings.PROFILING_TOKEN.encode())
+
+    def dump(self, request, profiler):
+        """Writes the pstats file, then deletes the oldest ones beyond PROFILING_MAX_DUMPS."""
+        os.makedirs(settings.PROFILING_DIR, exist_ok=True)
+        name = datetime.now().strftime('%Y%m%d-%H%M%S-%f') + '-' + request.method + re.sub(r'[^\w]+', '-', request.path).rstrip('-') + '.prof'
+        profiler.dump_stats(os.path.join(settings.PROFILING_DIR, name))
+        dumps = sorted(glob.glob(os.path.join(settings.PROFILING_DIR, '*.prof')))  # oldest first, by name
+        for path in dumps[:max(len(dumps) - settings.PROFILING_MAX_DUMPS, 0)]:
+            try:
+                os.remove(path)
+            except OSError:  # removed by another worker meanwhile
+                pass
+        return name
+
+
+class RequestIdMiddleware(object):
+    """Gives each request an id (the X-Request-ID header set by the proxy, or a new one), which api.log adds to every
+    record logged while handling it, and returns it in the X-Request-ID response header.
+
+    The id is cleared on request_finished rather than here, so django.request's "Not Found" warnings (logged after the
+    middleware returns) and logs while streaming the response still carry it.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.id = set_request_id(request.META.get('HTTP_X_REQUEST_ID', ''))
+        response = self.get_response(request)
+        response['X-Request-ID'] = request.id
+        return response
+
+
+class MetricsMiddleware(object):
+    """Records every request's latency and query count in api.metrics, labelled with the viewset and action that
+    handled it (`unresolved` when no view matched).
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        start_queries = query_count()
+        start_timer = timer()
+        response = self.get_response(request)
+        view, action = getattr(request, 'metrics_view', ('unresolved', ''))
+        REQUEST_DURATION.observe(timer() - start_timer, view=view, action=action, method=request.method, status=response.status_code)
+        DB_QUERIES.inc(query_count() - start_queries, view=view, action=action)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        cls = getattr(view_func, 'cls', None)  # DRF views; `actions` maps the HTTP methods of a viewset route to actions
+        if cls is None:
+            request.metrics_view = (view_func.__module__ + '.' + view_func.__name__, '')
+        else:
+            actions = getattr(view_func, 'actions', None) or {}
+            request.metrics_view = (cls.__name__, actions.get(request.method.lower(), request.method.lower()))
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.4 on 2026-10-19 15:52
+from __future__ import unicode_literals
+
+from datetime import timedelta
+
+from django.db import migrations, models
+
+
+def set_expires_at(apps, schema_editor):
+    MeetingProposal = apps.get_model('api', 'MeetingProposal')
+    for p in MeetingProposal.objects.filter(expires_at__isnull=True):
+        p.expires_at = p.timestamp + timedelta(minutes=p.expiration_minutes)
+        p.save(update_fields=['expires_at'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_auto_20171126_2113'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='meetingproposal',
+            name='expires_at',
+            field=models.DateTimeField(blank=True, db_index=True, editable=False, null=True),
+        ),
+        migrations.RunPython(set_expires_at, migrations.RunPython.noop),
+    ]
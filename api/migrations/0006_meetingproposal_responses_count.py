@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.4 on 2026-10-19 15:53
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def set_responses_count(apps, schema_editor):
+    MeetingProposal = apps.get_model('api', 'MeetingProposal')
+    for p in MeetingProposal.objects.annotate(count=models.Count('responses_received')):
+        p.responses_count = p.count
+        p.save(update_fields=['responses_count'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_meetingproposal_expires_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='meetingproposal',
+            name='responses_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(set_responses_count, migrations.RunPython.noop),
+    ]
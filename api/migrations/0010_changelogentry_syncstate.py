@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.4 on 2026-10-19 16:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_updated_at_collectionversion'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChangeLogEntry',
+            fields=[
+                ('seq', models.BigAutoField(primary_key=True, serialize=False)),
+                ('collection', models.CharField(editable=False, max_length=100)),
+                ('object_id', models.PositiveIntegerField(editable=False)),
+                ('deleted', models.BooleanField(default=False, editable=False)),
+                ('course_id', models.PositiveIntegerField(blank=True, db_index=True, editable=False, null=True)),
+                ('group_id', models.PositiveIntegerField(blank=True, db_index=True, editable=False, null=True)),
+                ('timestamp', models.DateTimeField(db_index=True, default=django.utils.timezone.now, editable=False)),
+            ],
+            options={
+                'ordering': ('seq',),
+            },
+        ),
+        migrations.CreateModel(
+            name='SyncState',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('horizon', models.BigIntegerField(default=0, editable=False)),
+            ],
+            options={
+                'verbose_name_plural': 'sync state',
+            },
+        ),
+        migrations.AlterIndexTogether(
+            name='changelogentry',
+            index_together=set([('collection', 'object_id')]),
+        ),
+    ]
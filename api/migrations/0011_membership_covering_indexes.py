@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    """(user_id, <object>_id) indexes on the members through tables, so a user's membership ids come from the index."""
+
+    dependencies = [
+        ('api', '0010_changelogentry_syncstate'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            ['CREATE INDEX api_course_members_user_course ON api_course_members (user_id, course_id)'],
+            ['DROP INDEX api_course_members_user_course'],
+        ),
+        migrations.RunSQL(
+            ['CREATE INDEX api_group_members_user_group ON api_group_members (user_id, group_id)'],
+            ['DROP INDEX api_group_members_user_group'],
+        ),
+        migrations.RunSQL(
+            ['CREATE INDEX api_meeting_members_user_meeting ON api_meeting_members (user_id, meeting_id)'],
+            ['DROP INDEX api_meeting_members_user_meeting'],
+        ),
+    ]
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.4 on 2026-10-19 16:22
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('api', '0011_membership_covering_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedCourseMessage',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('content', models.CharField(max_length=1023)),
+                ('timestamp', models.DateTimeField(editable=False)),
+                ('updated_at', models.DateTimeField(editable=False)),
+                ('course', models.ForeignKey(editable=False, on_delete=django.db.models.deletion.CASCADE, related_name='archived_messages', to='api.Course')),
+                ('creator', models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='archived_course_messages', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ('course', '-pk'),
+            },
+        ),
+        migrations.CreateModel(
+            name='ArchivedGroupMessage',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('content', models.CharField(max_length=1023)),
+                ('timestamp', models.DateTimeField(editable=False)),
+                ('updated_at', models.DateTimeField(editable=False)),
+                ('creator', models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='archived_group_messages', to=settings.AUTH_USER_MODEL)),
+                ('group', models.ForeignKey(editable=False, on_delete=django.db.models.deletion.CASCADE, related_name='archived_messages', to='api.Group')),
+            ],
+            options={
+                'ordering': ('group__course', 'group', '-pk'),
+            },
+        ),
+        migrations.AddField(
+            model_name='term',
+            name='messages_archived',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+    ]
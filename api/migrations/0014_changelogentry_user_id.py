@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.4 on 2026-10-19 17:10
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def fan_out_notification_entries(apps, schema_editor):
+    """Replaces each notification entry with one per current recipient and the creator; entries of notifications that
+    are already deleted have no one left to send them to and are dropped.
+    """
+    ChangeLogEntry = apps.get_model('api', 'ChangeLogEntry')
+    Notification = apps.get_model('api', 'Notification')
+    entries = ChangeLogEntry.objects.filter(collection='api.notification', user_id__isnull=True)
+    audiences = {}
+    for pk, user_id in Notification.recipients.through.objects.filter(notification_id__in=entries.values('object_id')).values_list('notification_id', 'user_id'):
+        audiences.setdefault(pk, set()).add(user_id)
+    for pk, creator_id in Notification.objects.filter(pk__in=entries.values('object_id'), creator__isnull=False).values_list('pk', 'creator_id'):
+        audiences.setdefault(pk, set()).add(creator_id)
+    ChangeLogEntry.objects.bulk_create([
+        ChangeLogEntry(collection=e.collection, object_id=e.object_id, deleted=e.deleted, timestamp=e.timestamp, user_id=user_id)
+        for e in entries.order_by('seq') for user_id in sorted(audiences.get(e.object_id, ()))
+    ], batch_size=500)
+    entries.delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0013_term_retirement'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='changelogentry',
+            name='user_id',
+            field=models.PositiveIntegerField(blank=True, db_index=True, editable=False, null=True),
+        ),
+        migrations.RunPython(fan_out_notification_entries, migrations.RunPython.noop),
+    ]
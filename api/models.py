@@ -1,15 +1,22 @@
+import json
 import logging
-from datetime import date, timedelta, timezone
+from datetime import date, timedelta
+from timeit import default_timer as timer
+from urllib.error import URLError
 
 from django.conf import settings
-from django.db import models
-from django.db.models import Sum, Count
-from django.db.models.signals import post_save, pre_save, post_delete, pre_delete
+from django.db import models, transaction, IntegrityError
+from django.db.models import Sum, Count, Exists, F, Max, OuterRef, Q
+from django.db.models.signals import m2m_changed, post_save, pre_save, post_delete, pre_delete
 from django.dispatch import receiver
+from django.utils import timezone
+from push_notifications.conf import get_manager
+from push_notifications.gcm import GCMError, send_message as gcm_send_message
 from push_notifications.models import GCMDevice
-from requests import HTTPError
 from rest_framework.authtoken.models import Token
 
+from .metrics import PUSH_MESSAGES, PUSH_RECIPIENTS, PUSH_SEND_DURATION
+
 # ~~~~~~~~ Other ~~~~~~~~ #
 
 
@@ -21,6 +28,7 @@ GROUP_INVITATION = 4
 MEETING_INVITATION = 5
 MEETING_PROPOSAL = 6
 MEETING_PROPOSAL_RESULT = 7
+NOTIFICATION_DIGEST = 8
 
 
 logger = logging.getLogger(__name__)
@@ -83,18 +91,76 @@ def delete_user(sender, instance=None, **kwargs):  # TODO: make sure userprofile
     instance.user.delete()
 
 
+# ~~~~~~~~ Push ~~~~~~~~ #
+
+
+def send_push(user_ids, data):
+    if not user_ids:
+        return
+    # one FCM request per application and chunk of at most max_recipients tokens; a failed request is logged and the rest
+    # still go out. django-push-notifications parses the per-token results, deactivates NotRegistered/InvalidRegistration
+    # tokens in bulk and applies canonical registration ids
+    batches = {}
+    for cloud_type, application_id, registration_id in GCMDevice.objects.filter(user_id__in=user_ids, active=True).values_list('cloud_message_type', 'application_id', 'registration_id'):
+        batches.setdefault((cloud_type, application_id), []).append(registration_id)
+    responses = []
+    for (cloud_type, application_id), registration_ids in batches.items():
+        size = get_manager().get_max_recipients(cloud_type, application_id)
+        for i in range(0, len(registration_ids), size):
+            start = timer()
+            try:  # the data dict is copied because the FCM payload is built by popping keys from it
+                response = gcm_send_message(registration_ids[i:i + size], dict(data), cloud_type, application_id=application_id, title=data["title"])
+            except GCMError as e:  # invalid tokens have already been pruned; the remaining errors are transient
+                response = e.args[0]
+                logger.warning("send_push: %s", e)
+            except URLError as e:
+                PUSH_SEND_DURATION.observe(timer() - start)
+                PUSH_MESSAGES.inc(result='error')
+                logger.warning("send_push: %s", e)
+                continue
+            PUSH_SEND_DURATION.observe(timer() - start)
+            responses.extend(response if isinstance(response, list) else [response])
+    success = sum(r.get("success", 0) for r in responses)
+    failure = sum(r.get("failure", 0) for r in responses)
+    canonical_ids = sum(r.get("canonical_ids", 0) for r in responses)
+    PUSH_MESSAGES.inc(success, result='sent')
+    PUSH_MESSAGES.inc(failure, result='failed')
+    logger.debug("send_push: %d users %d sent %d failed %d canonical ids", len(user_ids), success, failure, canonical_ids,
+                 extra={'users': len(user_ids), 'sent': success, 'failed': failure, 'canonical_ids': canonical_ids})
+
+
 # ~~~~~~~~ Models ~~~~~~~~ #
 
 
 # TODO: require unique georgia tech email for every user?
 class UserProfile(models.Model):
     user = models.OneToOneField(settings.AUTH_USER_MODEL, related_name="profile", on_delete=models.CASCADE)
+    last_push_at = models.DateTimeField(blank=True, null=True, editable=False)
+    push_window_start = models.DateTimeField(blank=True, null=True, editable=False)  # start of the current rate limit hour
+    push_window_count = models.PositiveIntegerField(default=0, editable=False)
 
     objects = GetOrNoneManager()
 
     def __str__(self):
         return self.user.first_name + ' ' + self.user.last_name
 
+    @staticmethod
+    def can_push(profile, now):
+        """Whether a push may go out now to the user with the given profile values (None if the user has no profile)."""
+        if profile is None:
+            return True
+        if profile['last_push_at'] and profile['last_push_at'] > now - timedelta(seconds=settings.PUSH_COALESCE_WINDOW):
+            return False
+        if profile['push_window_start'] and profile['push_window_start'] > now - timedelta(hours=1):
+            return profile['push_window_count'] < settings.PUSH_MAX_PER_HOUR
+        return True
+
+    @classmethod
+    def record_pushes(cls, user_ids, now):
+        profiles = cls.objects.filter(user_id__in=user_ids)
+        profiles.filter(Q(push_window_start__isnull=True) | Q(push_window_start__lte=now - timedelta(hours=1))).update(push_window_start=now, push_window_count=0)
+        profiles.update(last_push_at=now, push_window_count=F('push_window_count') + 1)
+
 
 class Term(models.Model):
     name = models.CharField(max_length=255, editable=False)
@@ -102,6 +168,8 @@ class Term(models.Model):
     start_date = models.DateField(editable=False)
     end_date = models.DateField(editable=False)
     subjects_loaded = models.BooleanField(default=False)
+    messages_archived = models.BooleanField(default=False, editable=False)  # chats closed; messages live in the archive tables
+    retired = models.BooleanField(default=False, editable=False)  # left out of the default subject and course lists
 
     objects = GetOrNoneManager()
 
@@ -124,6 +192,54 @@ class Term(models.Model):
             terms = cls.objects.filter(start_date__lte=today + timedelta(days=14), end_date__gte=today)  # allow term to be current if within 2 weeks of starting
         return terms.first() if terms else None
 
+    def retire(self, batch_size=1000, progress=None):
+        """Marks the term's courses, groups and meetings retired, batch_size rows per transaction, then the term itself.
+
+        Retired rows drop out of the default lists (their meeting times and sections go with their course) but can
+        still be retrieved. `progress(model, count)` is called after each batch. Returns the number of rows retired.
+        """
+        retired = 0
+        for model, term_lookup in ((Course, 'subject__term'), (Group, 'course__subject__term'), (Meeting, 'course__subject__term')):
+            pending = model.objects.filter(retired=False, **{term_lookup: self}).order_by('pk').values_list('pk', flat=True)
+            while True:
+                with transaction.atomic():
+                    pks = list(pending[:batch_size])
+                    model.objects.filter(pk__in=pks).update(retired=True)
+                    if pks:
+                        CollectionVersion.bump(model)
+                retired += len(pks)
+                if pks and progress:
+                    progress(model, len(pks))
+                if len(pks) < batch_size:
+                    break
+        Term.objects.filter(pk=self.pk).update(retired=True)
+        self.retired = True
+        return retired
+
+    def archive_messages(self, batch_size=1000):
+        """Moves the term's course and group messages to the archive tables, batch_size rows per transaction.
+
+        The term is marked archived first, which closes its chats and sends its message reads to the archive. Returns the
+        number of messages moved; safe to run again (e.g. after an interruption).
+        """
+        if not self.messages_archived:
+            Term.objects.filter(pk=self.pk).update(messages_archived=True)
+            self.messages_archived = True
+        moved = 0
+        for model, archive_model, term_lookup in MESSAGE_ARCHIVES:
+            fields = [f.attname for f in model._meta.concrete_fields]
+            messages = model.objects.filter(**{term_lookup: self}).order_by('pk').values(*fields)
+            while True:
+                with transaction.atomic():
+                    rows = list(messages[:batch_size])
+                    archive_model.objects.bulk_create([archive_model(**row) for row in rows])
+                    # _raw_delete skips the delete signals: the messages still exist, so no change log tombstones
+                    model.objects.filter(pk__in=[row['id'] for row in rows])._raw_delete(model.objects.db)
+                moved += len(rows)
+                if len(rows) < batch_size:
+                    break
+        return moved
+
     @property
     def subjects_total_count(self):
         return self.subjects.all().count()
@@ -187,6 +303,8 @@ class Course(models.Model):
     sections = models.ManyToManyField(Section, related_name="courses_as_section", editable=False)
     members = models.ManyToManyField(settings.AUTH_USER_MODEL, related_name="courses_as_member")
     is_cancelled = models.BooleanField(default=False, editable=False)
+    retired = models.BooleanField(default=False, db_index=True, editable=False)  # term ended (see Term.retire)
+    updated_at = models.DateTimeField(auto_now=True)
 
     objects = GetOrNoneManager()
 
@@ -230,6 +348,8 @@ class Group(models.Model):
     course = models.ForeignKey(Course, related_name="groups", on_delete=models.CASCADE, editable=False)
     creator = models.ForeignKey(settings.AUTH_USER_MODEL, related_name="groups_as_creator", blank=True, null=True, on_delete=models.SET_NULL, editable=False)
     members = models.ManyToManyField(settings.AUTH_USER_MODEL, related_name="groups_as_member", blank=True)  # TODO: fix name clash with User.groups?
+    retired = models.BooleanField(default=False, db_index=True, editable=False)  # term ended (see Term.retire)
+    updated_at = models.DateTimeField(auto_now=True)
 
     objects = GetOrNoneManager()
 
@@ -254,6 +374,8 @@ class Meeting(models.Model):
     course = models.ForeignKey(Course, related_name="meetings", on_delete=models.CASCADE, editable=False)
     creator = models.ForeignKey(settings.AUTH_USER_MODEL, related_name="meetings_as_creator", blank=True, null=True, on_delete=models.SET_NULL, editable=False)
     members = models.ManyToManyField(settings.AUTH_USER_MODEL, related_name="meetings_as_member", blank=True)
+    retired = models.BooleanField(default=False, db_index=True, editable=False)  # term ended (see Term.retire)
+    updated_at = models.DateTimeField(auto_now=True)
 
     objects = GetOrNoneManager()
 
@@ -273,6 +395,7 @@ class CourseMessage(models.Model):
     course = models.ForeignKey(Course, related_name="messages", on_delete=models.CASCADE, editable=False)
     creator = models.ForeignKey(settings.AUTH_USER_MODEL, related_name ="course_messages", blank=True, null=True, on_delete=models.SET_NULL, editable=False)
     timestamp = models.DateTimeField(auto_now_add=True, editable=False)
+    updated_at = models.DateTimeField(auto_now=True)
 
     objects = GetOrNoneManager()
 
@@ -288,6 +411,7 @@ class GroupMessage(models.Model):
     group = models.ForeignKey(Group, related_name="messages", on_delete=models.CASCADE, editable=False)
     creator = models.ForeignKey(settings.AUTH_USER_MODEL, related_name ="group_messages", blank=True, null=True, on_delete=models.SET_NULL, editable=False)
     timestamp = models.DateTimeField(auto_now_add=True, editable=False)
+    updated_at = models.DateTimeField(auto_now=True)
 
     objects = GetOrNoneManager()
 
@@ -298,6 +422,43 @@ class GroupMessage(models.Model):
         return str(self.group) + ' - ' + self.content
 
 
+class ArchivedCourseMessage(models.Model):  # CourseMessage of an ended term (see Term.archive_messages)
+    id = models.IntegerField(primary_key=True)  # the CourseMessage pk
+    content = models.CharField(max_length=1023)
+    course = models.ForeignKey(Course, related_name="archived_messages", on_delete=models.CASCADE, editable=False)
+    creator = models.ForeignKey(settings.AUTH_USER_MODEL, related_name ="archived_course_messages", blank=True, null=True, on_delete=models.SET_NULL, editable=False)
+    timestamp = models.DateTimeField(editable=False)
+    updated_at = models.DateTimeField(editable=False)
+
+    class Meta:
+        ordering = ('course', '-pk')
+
+    def __str__(self):
+        return str(self.course) + ' - ' + self.content
+
+
+class ArchivedGroupMessage(models.Model):  # GroupMessage of an ended term (see Term.archive_messages)
+    id = models.IntegerField(primary_key=True)  # the GroupMessage pk
+    content = models.CharField(max_length=1023)
+    group = models.ForeignKey(Group, related_name="archived_messages", on_delete=models.CASCADE, editable=False)
+    creator = models.ForeignKey(settings.AUTH_USER_MODEL, related_name ="archived_group_messages", blank=True, null=True, on_delete=models.SET_NULL, editable=False)
+    timestamp = models.DateTimeField(editable=False)
+    updated_at = models.DateTimeField(editable=False)
+
+    class Meta:
+        ordering = ('group__course', 'group', '-pk')
+
+    def __str__(self):
+        return str(self.group) + ' - ' + self.content
+
+
+# (hot model, archive model, lookup of the message's term)
+MESSAGE_ARCHIVES = (
+    (CourseMessage, ArchivedCourseMessage, 'course__subject__term'),
+    (GroupMessage, ArchivedGroupMessage, 'group__course__subject__term'),
+)
+
+
 class Notification(models.Model):
     title = models.CharField(max_length=255)
     message = models.CharField(max_length=255)  # TODO: CharField instead?
@@ -306,6 +467,8 @@ class Notification(models.Model):
     recipients = models.ManyToManyField(settings.AUTH_USER_MODEL, related_name="notifications_as_recipient")
     recipients_read_by = models.ManyToManyField(settings.AUTH_USER_MODEL, related_name="notifications_as_recipient_read_by")
     timestamp = models.DateTimeField(auto_now_add=True, editable=False)
+    updated_at = models.DateTimeField(auto_now=True)
+    payload = models.TextField(blank=True, editable=False)  # push data as compact JSON, built once by set_data() (without the id)
 
     objects = GetOrNoneManager()
 
@@ -313,27 +476,61 @@ class Notification(models.Model):
         super().__init__(*args, **kwargs)
         self.data = {}
 
+    def save(self, *args, **kwargs):
+        if self.pk is None and not self.payload:
+            # built before the INSERT from the relations the subclasses' save() already loaded for the title and message
+            self.payload = self.build_payload()
+        super().save(*args, **kwargs)
+
     def read_by(self, user):
         self.recipients_read_by.add(user)
 
+    @staticmethod
+    def audiences(pks):
+        """{notification id: ids of its recipients and creator}."""
+        audiences = {pk: set() for pk in pks}
+        if pks:
+            for pk, user_id in Notification.recipients.through.objects.filter(notification_id__in=pks).values_list('notification_id', 'user_id'):
+                audiences[pk].add(user_id)
+            for pk, creator_id in Notification.objects.filter(pk__in=pks, creator__isnull=False).values_list('pk', 'creator_id'):
+                audiences[pk].add(creator_id)
+        return audiences
+
     def set_data(self):
         self.data["title"] = self.title
         self.data["message"] = self.message
         self.data["message_expanded"] = self.message_expanded
-        self.data["creator_first_name"] = self.creator.first_name
-
-    def broadcast(self):  # TODO: clean up
-        self.set_data()  # TODO: THIS SHOULD CALL SUBCLASS METHOD
-        logger.debug("Notification.broadcast: self.data: " + str(self.data))
-        count = 0
-        for r in self.recipients.all():
-            for d in r.gcmdevice_set.all():
-                try:
-                    d.send_message(self.message, title=self.title, extra=self.data)
-                except HTTPError as e:
-                    logger.debug(str(e))
-                count += 1
-        logger.debug("Notification.broadcast: " + str(self.recipients.count()) + " recipients " + str(count) + " devices")
+        self.data["creator_first_name"] = self.creator.first_name if self.creator else ""  # creator may have been deleted
+
+    def build_payload(self):
+        self.set_data()
+        return json.dumps(self.data, separators=(',', ':'))
+
+    def get_payload(self):
+        if not self.payload:  # notifications created before payloads were stored
+            self.payload = self.build_payload()
+            Notification.objects.filter(pk=self.pk).update(payload=self.payload)
+        return self.push_data(self.pk, self.payload)
+
+    @staticmethod
+    def push_data(pk, payload):
+        """The push data of a stored payload, with the notification id, which isn't known yet when the payload is built."""
+        data = json.loads(payload)
+        data["id"] = pk
+        return data
+
+    def broadcast(self):
+        data = self.get_payload()
+        if logger.isEnabledFor(logging.DEBUG):  # payloads can be large; only dumped when debugging
+            logger.debug("Notification.broadcast: payload of notification %d", self.pk, extra={'payload': data})
+        user_ids = list(self.recipients.values_list('pk', flat=True))
+        send_now, queued = QueuedPush.route(user_ids)
+        if queued:
+            QueuedPush.objects.bulk_create([QueuedPush(user_id=user_id, notification_id=self.pk) for user_id in queued])
+        send_push(send_now, data)
+        PUSH_RECIPIENTS.inc(len(send_now), route='now')
+        PUSH_RECIPIENTS.inc(len(queued), route='queued')
+        logger.debug("Notification.broadcast: %d sent %d queued", len(send_now), len(queued))
 
 
 class StandardNotification(Notification):
@@ -347,7 +544,6 @@ class StandardNotification(Notification):
     def set_data(self):
         super().set_data()
         self.data["type"] = STANDARD_NOTIFICATION
-        self.data["id"] = self.pk
 
 
 class GroupNotification(StandardNotification):
@@ -381,7 +577,7 @@ class GroupInvitation(GroupNotification):
 
     def save(self, *args, **kwargs):
         if self.pk is None:
-            self.title = self.meeting.course.short_name + " - Group Invitation"
+            self.title = self.group.course.short_name + " - Group Invitation"
             self.message = self.creator.first_name + " has invited you to their group"
             self.message_expanded = self.message + "\n\n" + self.group.name
         super().save(*args, **kwargs)
@@ -389,7 +585,6 @@ class GroupInvitation(GroupNotification):
     def set_data(self):
         super().set_data()
         self.data["type"] = GROUP_INVITATION
-        self.data["id"] = self.pk
 
 
 class MeetingNotification(StandardNotification):
@@ -425,7 +620,8 @@ class MeetingInvitation(MeetingNotification):
         if self.pk is None:
             self.title = self.meeting.course.short_name + " - Meeting Invitation"
             self.message = self.creator.first_name + " has invited you to their meeting"
-            self.message_expanded = self.message + "\n\nName: " + self.meeting.name + "\nLocation: " + self.meeting.location + "\nStart Date: " + str(self.meeting.start_date) + "\nStart Time: " + str(self.meeting.start_time) + "\nDuration: " + str(self.meeting.duration_minutes) + "\nDescription: " + self.meeting.description
+            m = self.meeting
+            self.message_expanded = "%s\n\nName: %s\nLocation: %s\nStart Date: %s\nStart Time: %s\nDuration: %s\nDescription: %s" % (self.message, m.name, m.location, m.start_date, m.start_time, m.duration_minutes, m.description)
         super().save(*args, **kwargs)
 
     def set_data(self):
@@ -439,6 +635,8 @@ class MeetingProposal(MeetingNotification):  # TODO: disallow deletes
     start_time = models.TimeField(blank=True)
     responses_received = models.ManyToManyField(settings.AUTH_USER_MODEL, related_name="meeting_proposals_responses_received", blank=True, editable=False)
     expiration_minutes = models.PositiveIntegerField(default=60, blank=True)  # expires in 1 hr by default TODO allow user to set?
+    expires_at = models.DateTimeField(blank=True, null=True, db_index=True, editable=False)
+    responses_count = models.PositiveIntegerField(default=0, editable=False)
     applied = models.BooleanField(default=False, blank=True, editable=False)
     closed = models.BooleanField(default=False, blank=True, editable=False)
 
@@ -447,7 +645,7 @@ class MeetingProposal(MeetingNotification):  # TODO: disallow deletes
 
     @property
     def is_expired(self):
-        return (self.timestamp + timedelta(minutes=self.expiration_minutes)) < timezone.now()
+        return self.expires_at is not None and self.expires_at <= timezone.now()
 
     @property
     def is_closed(self):
@@ -461,8 +659,11 @@ class MeetingProposal(MeetingNotification):  # TODO: disallow deletes
                 self.start_date = self.meeting.start_date
             if not self.start_time:
                 self.start_time = self.meeting.start_time
+            if self.expires_at is None:
+                self.expires_at = timezone.now() + timedelta(minutes=self.expiration_minutes)
             self.message = self.creator.first_name + " has proposed a time/location change"
-            self.message_expanded = self.message + "\n\nFrom:\n" +  self.meeting.location + "\n" + str(self.meeting.start_date) + " " + str(self.meeting.start_time) + "\n\nTo:\n" +  self.location + "\n" + str(self.start_date) + " " + str(self.start_time)
+            m = self.meeting
+            self.message_expanded = "%s\n\nFrom:\n%s\n%s %s\n\nTo:\n%s\n%s %s" % (self.message, m.location, m.start_date, m.start_time, self.location, self.start_date, self.start_time)
         super().save(*args, **kwargs)
 
     def set_data(self):
@@ -473,32 +674,106 @@ class MeetingProposal(MeetingNotification):  # TODO: disallow deletes
         self.data["start_time"] = str(self.start_time)
 
     def approve_by(self, user):
-        if not self.closed:
-            self.responses_received.add(user)
-            self.save()
-            if self.responses_received.count() == (self.meeting.members.count() - 1):  # TODO: do a more robust check
-                self.apply()
+        if self.is_expired:
+            self.close()
+            return
+        try:
+            with transaction.atomic():
+                # the conditional UPDATE takes the row lock, so concurrent votes are counted one at a time
+                if not MeetingProposal.objects.filter(pk=self.pk, closed=False).update(responses_count=F('responses_count') + 1):
+                    return
+                self._touch()
+                MeetingProposal.responses_received.through.objects.create(meetingproposal_id=self.pk, user_id=user.pk)
+                record_changes(MeetingProposal, [self.pk])
+                self.responses_count = MeetingProposal.objects.values_list('responses_count', flat=True).get(pk=self.pk)
+        except IntegrityError:  # already responded
+            return
+        if self.responses_count >= (self.meeting.members.count() - 1):  # TODO: do a more robust check
+            self.apply()
 
     def reject_by(self, user):
         if not self.closed:
             self.responses_received.add(user)
-            self.save()
             self.close()
 
     def apply(self):
-        m = self.meeting
-        m.location = self.location
-        m.start_date = self.start_date
-        m.start_time = self.start_time
-        m.save()
-        self.applied = True
-        self.save()
-        self.close()
+        with transaction.atomic():
+            if not self._mark_closed(applied=True):
+                return
+            m = self.meeting
+            m.location = self.location
+            m.start_date = self.start_date
+            m.start_time = self.start_time
+            m.save()
+            self._create_result()
 
     def close(self):
+        with transaction.atomic():
+            if self._mark_closed():
+                self._create_result()
+
+    def _mark_closed(self, applied=False):
+        """Closes the proposal in a single conditional UPDATE; only the caller that actually closed it gets True."""
+        if not MeetingProposal.objects.filter(pk=self.pk, closed=False).update(closed=True, applied=applied):
+            return False
+        self._touch()
+        record_changes(MeetingProposal, [self.pk])
         self.closed = True
-        self.save()
-        MeetingProposalResult.objects.create(meeting_proposal=self, meeting=self.meeting, creator=self.creator)
+        self.applied = applied
+        return True
+
+    def _touch(self):
+        """Sets updated_at, which lives in the parent Notification table, in an UPDATE of its own: update() of parent
+        fields first SELECTs the matching pks and then updates by pk, so the closed=False condition would no longer be
+        checked atomically by the conditional UPDATEs above.
+        """
+        Notification.objects.filter(pk=self.pk).update(updated_at=timezone.now())
+
+    def _create_result(self):
+        result = MeetingProposalResult.objects.create(meeting_proposal=self, meeting=self.meeting, creator=self.creator)
+        result.recipients = self.meeting.members.all()  # TODO: DO send notification to creator
+        transaction.on_commit(result.broadcast)
+
+    @classmethod
+    def close_expired(cls, now=None):
+        """Close every open proposal past its expires_at in one batched pass.
+
+        Returns the created MeetingProposalResult objects; their broadcasts are sent once the transaction commits.
+        """
+        now = now or timezone.now()
+        with transaction.atomic():
+            proposals = list(cls.objects.select_for_update()
+                             .select_related('creator', 'meeting__course__subject')
+                             .filter(closed=False, expires_at__lte=now))
+            # closed one by one with the same conditional UPDATE as _mark_closed: select_for_update is a no-op on SQLite,
+            # so a vote may have closed (and applied) a proposal since it was read
+            proposals = [p for p in proposals if cls.objects.filter(pk=p.pk, closed=False).update(closed=True)]
+            if not proposals:
+                return []
+            Notification.objects.filter(pk__in=[p.pk for p in proposals]).update(updated_at=now)  # see _touch
+            record_changes(cls, [p.pk for p in proposals])
+
+            meeting_ids = {p.meeting_id for p in proposals}
+            members_by_meeting = {}
+            for meeting_id, user_id in Meeting.members.through.objects.filter(meeting_id__in=meeting_ids).values_list('meeting_id', 'user_id'):
+                members_by_meeting.setdefault(meeting_id, []).append(user_id)
+
+            results = []
+            for p in proposals:
+                p.closed = True
+                result = MeetingProposalResult(meeting_proposal=p, meeting=p.meeting, creator=p.creator)
+                result.save()  # multi-table inheritance rules out bulk_create
+                results.append(result)
+
+            through = Notification.recipients.through
+            through.objects.bulk_create([
+                through(notification_id=r.pk, user_id=user_id)
+                for r in results for user_id in members_by_meeting.get(r.meeting_id, [])
+            ])
+            record_changes(MeetingProposalResult, [r.pk for r in results])  # bulk_create sends no m2m_changed
+
+            transaction.on_commit(lambda: [r.broadcast() for r in results])
+        return results
 
 
 @receiver(post_save, sender=MeetingProposal)
@@ -506,7 +781,7 @@ def dispatch_meeting_proposals(sender, instance=None, created=False, **kwargs):
     if created:
         instance.recipients = instance.meeting.members.all()
         instance.recipients.remove(instance.creator)  # TODO: don't send notification to creator
-        instance.broadcast()
+        transaction.on_commit(instance.broadcast)
 
 
 class MeetingProposalResult(MeetingNotification):  # TODO: disallow deletes
@@ -520,6 +795,9 @@ class MeetingProposalResult(MeetingNotification):  # TODO: disallow deletes
             if self.meeting_proposal.applied:
                 self.message = "Meeting time/location has been changed"
                 self.message_expanded = self.message + "\n\n" +  self.meeting.location + "\n" + str(self.meeting.start_date) + " " + str(self.meeting.start_time)
+            elif self.meeting_proposal.is_expired:
+                self.message = "Proposal for new meeting time/location has expired"
+                self.message_expanded = self.message
             else:
                 self.message = "Proposal for new meeting time/location has been rejected"
                 self.message_expanded = self.message
@@ -534,11 +812,254 @@ class MeetingProposalResult(MeetingNotification):  # TODO: disallow deletes
         self.data["start_time"] = str(self.meeting_proposal.start_time)
 
 
-@receiver(post_save, sender=MeetingProposalResult)
-def send_meeting_proposal_results(sender, instance=None, created=False, **kwargs):
-    if created:
-        instance.recipients = instance.meeting.members.all()  # TODO: DO send notification to creator
-        instance.broadcast()
+class QueuedPush(models.Model):
+    """A push held back because its recipient was pushed to recently; flushed later as part of a digest."""
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, related_name="queued_pushes", on_delete=models.CASCADE, editable=False)
+    notification = models.ForeignKey(Notification, related_name="queued_pushes", on_delete=models.CASCADE, editable=False)
+    timestamp = models.DateTimeField(auto_now_add=True, editable=False)
+
+    class Meta:
+        ordering = ('user', 'pk')
+
+    def __str__(self):
+        return str(self.user) + ' - Notification ' + str(self.notification_id)
+
+    @classmethod
+    def route(cls, user_ids, now=None):
+        """Splits recipients into users that can be pushed to right away and users whose push gets queued."""
+        if not settings.PUSH_COALESCE_WINDOW or not user_ids:
+            return user_ids, []
+        now = now or timezone.now()
+        pending = set(cls.objects.filter(user_id__in=user_ids).values_list('user_id', flat=True))
+        profiles = {p['user_id']: p for p in UserProfile.objects.filter(user_id__in=user_ids).values('user_id', 'last_push_at', 'push_window_start', 'push_window_count')}
+        send_now, queued = [], []
+        for user_id in user_ids:
+            if user_id not in pending and UserProfile.can_push(profiles.get(user_id), now):
+                send_now.append(user_id)
+            else:
+                queued.append(user_id)
+        if send_now:
+            UserProfile.record_pushes(send_now, now)
+        return send_now, queued
+
+    @classmethod
+    def flush(cls, now=None):
+        """Sends one push per user with queued notifications whose coalescing window has passed.
+
+        A single queued notification is sent as is; several are merged into one "N new updates" digest.
+        Returns the number of users pushed to.
+        """
+        now = now or timezone.now()
+        with transaction.atomic():
+            pending = list(cls.objects.order_by().values('user_id').annotate(count=Count('pk'), latest_notification_id=Max('notification_id'), last_pk=Max('pk')))
+            profiles = {p['user_id']: p for p in UserProfile.objects.filter(user_id__in=[q['user_id'] for q in pending]).values('user_id', 'last_push_at', 'push_window_start', 'push_window_count')}
+            due = [q for q in pending if UserProfile.can_push(profiles.get(q['user_id']), now)]
+            if not due:
+                return 0
+            for q in due:
+                cls.objects.filter(user_id=q['user_id'], pk__lte=q['last_pk']).delete()
+            UserProfile.record_pushes([q['user_id'] for q in due], now)
+
+            # users receiving the same push are batched into one send
+            payloads = dict(Notification.objects.filter(pk__in=[q['latest_notification_id'] for q in due if q['count'] == 1]).values_list('pk', 'payload'))
+            batches = {}
+            for q in due:
+                if q['count'] == 1 and payloads.get(q['latest_notification_id']):
+                    key = json.dumps(Notification.push_data(q['latest_notification_id'], payloads[q['latest_notification_id']]), separators=(',', ':'))
+                else:
+                    key = json.dumps({
+                        "type": NOTIFICATION_DIGEST,
+                        "title": "GTCollab",
+                        "message": "%d new updates" % q['count'],
+                        "count": q['count'],
+                    }, separators=(',', ':'))
+                batches.setdefault(key, []).append(q['user_id'])
+            transaction.on_commit(lambda: [send_push(user_ids, json.loads(key)) for key, user_ids in batches.items()])
+        return len(due)
+
+
+class CollectionVersion(models.Model):
+    """Change counter of a collection: a model together with its multi-table subclasses (see collection_name).
+
+    Bumped in the same transaction as every save, delete and M2M change of the VERSIONED_MODELS (and by record_changes
+    for queryset updates that bypass those signals), so views can tell whether a list changed from a single row.
+    """
+    name = models.CharField(max_length=100, primary_key=True)
+    version = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return self.name + ' v' + str(self.version)
+
+    @staticmethod
+    def collection_name(model):
+        parents = model._meta.get_parent_list()  # nearest first
+        return (parents[-1] if parents else model)._meta.label_lower
+
+    @classmethod
+    def bump(cls, *models):
+        now = timezone.now()
+        for name in sorted({cls.collection_name(m) for m in models}):  # same lock order in every transaction
+            if cls.objects.filter(name=name).update(version=F('version') + 1, updated_at=now):
+                continue
+            try:
+                with transaction.atomic():
+                    cls.objects.create(name=name, version=1, updated_at=now)
+            except IntegrityError:  # created concurrently
+                cls.objects.filter(name=name).update(version=F('version') + 1, updated_at=now)
+
+    @classmethod
+    def stamps(cls, models):
+        """[(name, version, updated_at)] for the collections of the given models; never-changed ones are version 0."""
+        names = sorted({cls.collection_name(m) for m in models})
+        rows = {v.name: v for v in cls.objects.filter(name__in=names)}
+        return [(name, rows[name].version, rows[name].updated_at) if name in rows else (name, 0, None) for name in names]
+
+
+class ChangeLogEntry(models.Model):
+    """A save, delete or M2M change of a synced object (SYNC_SCOPES), read by the sync endpoint in seq order.
+
+    Entries carry the course or group that decides who sees them. A notification change is logged once per recipient
+    and the creator at the time (user_id) instead, so its tombstone still reaches them after the recipient rows are
+    deleted with it. compact() drops entries superseded by a later one for the same object (and user) and tombstones
+    older than SYNC_TOMBSTONE_DAYS, raising SyncState.horizon past the dropped tombstones.
+    """
+    seq = models.BigAutoField(primary_key=True)
+    collection = models.CharField(max_length=100, editable=False)  # CollectionVersion.collection_name
+    object_id = models.PositiveIntegerField(editable=False)
+    deleted = models.BooleanField(default=False, editable=False)
+    course_id = models.PositiveIntegerField(blank=True, null=True, db_index=True, editable=False)  # plain ids: tombstones outlive the rows
+    group_id = models.PositiveIntegerField(blank=True, null=True, db_index=True, editable=False)
+    user_id = models.PositiveIntegerField(blank=True, null=True, db_index=True, editable=False)
+    timestamp = models.DateTimeField(default=timezone.now, db_index=True, editable=False)
+
+    class Meta:
+        ordering = ('seq',)
+        index_together = (('collection', 'object_id'),)
+
+    def __str__(self):
+        return str(self.seq) + ' ' + self.collection + ' ' + str(self.object_id) + (' deleted' if self.deleted else '')
+
+    @classmethod
+    def log(cls, model, pks=(), instances=(), deleted=False):
+        collection = CollectionVersion.collection_name(model)
+        if collection not in SYNC_SCOPES:
+            return
+        fields = ['pk'] + [f for f in SYNC_SCOPES[collection] if f]
+        if pks:
+            rows = [dict(zip(fields, row)) for row in model.objects.filter(pk__in=pks).values_list(*fields)]
+        else:
+            rows = [{f: getattr(i, f) for f in fields} for i in instances]
+        audiences = None
+        if collection == 'api.notification':
+            audiences = {i.pk: i.sync_audience for i in instances if hasattr(i, 'sync_audience')}  # deleted (see remember_audience)
+            audiences.update(Notification.audiences([row['pk'] for row in rows if row['pk'] not in audiences]))
+        cls.objects.bulk_create([cls(collection=collection, object_id=row['pk'], deleted=deleted, course_id=row.get('course_id'),
+                                     group_id=row.get('group_id'), user_id=user_id)
+                                 for row in rows for user_id in (sorted(audiences[row['pk']]) if audiences is not None else [None])])
+
+    @classmethod
+    def visible_to(cls, user):
+        return cls.objects.filter(
+            Q(course_id__in=Course.members.through.objects.filter(user_id=user.pk).values('course_id')) |
+            Q(group_id__in=Group.members.through.objects.filter(user_id=user.pk).values('group_id')) |
+            Q(user_id=user.pk))
+
+    @classmethod
+    def settled_seq(cls, now=None):
+        """Highest seq below which no entry can still be uncommitted (transactions run shorter than SYNC_SETTLE_SECONDS)."""
+        now = now or timezone.now()
+        unsettled = cls.objects.filter(timestamp__gt=now - timedelta(seconds=settings.SYNC_SETTLE_SECONDS)).order_by('seq').values_list('seq', flat=True)[:1]
+        if unsettled:
+            return unsettled[0] - 1
+        return cls.objects.aggregate(seq=Max('seq'))['seq'] or SyncState.load().horizon
+
+    @classmethod
+    def compact(cls, now=None):
+        """Returns the number of entries removed."""
+        now = now or timezone.now()
+        later = cls.objects.filter(Q(user_id=OuterRef('user_id')) | Q(user_id__isnull=True),  # for notifications, the same user's
+                                   collection=OuterRef('collection'), object_id=OuterRef('object_id'), seq__gt=OuterRef('seq'))
+        superseded = list(cls.objects.annotate(superseded=Exists(later)).filter(superseded=True).values_list('seq', flat=True))
+        for i in range(0, len(superseded), 500):
+            cls.objects.filter(seq__in=superseded[i:i + 500]).delete()
+        with transaction.atomic():
+            expired = cls.objects.filter(deleted=True, timestamp__lt=now - timedelta(days=settings.SYNC_TOMBSTONE_DAYS))
+            horizon = expired.aggregate(seq=Max('seq'))['seq']
+            if horizon is None:
+                return len(superseded)
+            state = SyncState.load()
+            state.horizon = max(state.horizon, horizon)
+            state.save()
+            return len(superseded) + cls.objects.filter(deleted=True, seq__lte=horizon).delete()[0]
+
+
+class SyncState(SingletonModel):
+    horizon = models.BigIntegerField(default=0, editable=False)  # sync tokens below this may have missed a tombstone
+
+    class Meta:
+        verbose_name_plural = 'sync state'
+
+    def __str__(self):
+        return 'Sync State'
+
+
+VERSIONED_MODELS = (settings.AUTH_USER_MODEL, Course, Group, Meeting, CourseMessage, GroupMessage, Notification,
+                    StandardNotification, GroupNotification, GroupInvitation, MeetingNotification, MeetingInvitation,
+                    MeetingProposal, MeetingProposalResult)
+
+# collection: (course field, group field) that scope who sees its change log entries
+SYNC_SCOPES = {
+    'api.group': ('course_id', None),
+    'api.meeting': ('course_id', None),
+    'api.coursemessage': ('course_id', None),
+    'api.groupmessage': (None, 'group_id'),
+    'api.notification': (None, None),
+}
+
+
+def record_changes(model, pks):
+    """Bumps the collection version and logs the change for updates that bypass model signals (queryset updates)."""
+    CollectionVersion.bump(model)
+    ChangeLogEntry.log(model, pks=pks)
+
+
+def record_save(sender, instance=None, **kwargs):
+    CollectionVersion.bump(sender)
+    ChangeLogEntry.log(sender, instances=[instance])
+
+
+def record_delete(sender, instance=None, **kwargs):
+    CollectionVersion.bump(sender)
+    if not sender._meta.parents:  # deleting a multi-table child also sends post_delete for each parent row
+        ChangeLogEntry.log(sender, instances=[instance], deleted=True)
+
+
+def remember_audience(sender, instance=None, **kwargs):
+    """Keeps a deleted notification's recipients and creator for its tombstone: the recipient rows are deleted first."""
+    instance.sync_audience = Notification.audiences([instance.pk])[instance.pk]
+
+
+def record_m2m_change(sender, instance=None, action=None, reverse=False, model=None, pk_set=None, **kwargs):
+    """Touches updated_at on the side of the relation that declares the M2M field and records the change there."""
+    if not action.startswith('post_') or pk_set is not None and not pk_set:
+        return
+    owner, pks = (model, pk_set) if reverse else (type(instance), {instance.pk})
+    if pks:  # None for a reverse clear()
+        owner.objects.filter(pk__in=pks).update(updated_at=timezone.now())
+        ChangeLogEntry.log(owner, pks=pks)
+    CollectionVersion.bump(owner)
+
+
+for versioned_model in VERSIONED_MODELS:
+    post_save.connect(record_save, sender=versioned_model)
+    post_delete.connect(record_delete, sender=versioned_model)
+pre_delete.connect(remember_audience, sender=Notification)
+for through in (Course.sections.through, Course.members.through, Group.members.through, Meeting.members.through,
+                Notification.recipients.through, Notification.recipients_read_by.through,
+                MeetingProposal.responses_received.through):
+    m2m_changed.connect(record_m2m_change, sender=through)
+del versioned_model, through
 
 
 class ServerData(SingletonModel):
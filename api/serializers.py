@@ -1,6 +1,12 @@
+from collections import OrderedDict
+
 from django.contrib.auth.models import User
+from django.db import transaction
+from django.utils import timezone
 from rest_framework import serializers
+from rest_framework.relations import MANY_RELATION_KWARGS
 
+from .membership import membership
 from .models import *
 
 
@@ -12,7 +18,7 @@ class IsCourseMemberValidator(object):
         self.user = None
 
     def __call__(self, course):
-        if not self.user.courses_as_member.filter(pk=course.pk):
+        if not membership(self.user).has('courses', course.pk):
             message = 'Must be course member'
             raise serializers.ValidationError(message)
 
@@ -25,7 +31,7 @@ class IsGroupMemberValidator(object):
         self.user = None
 
     def __call__(self, group):
-        if not self.user.groups_as_member.filter(pk=group.pk):
+        if not membership(self.user).has('groups', group.pk):
             message = 'Must be course member'
             raise serializers.ValidationError(message)
 
@@ -38,7 +44,7 @@ class IsMeetingMemberValidator(object):
         self.user = None
 
     def __call__(self, meeting):
-        if not self.user.meetings_as_member.filter(pk=meeting.pk):
+        if not membership(self.user).has('meetings', meeting.pk):
             message = 'Must be meeting member'
             raise serializers.ValidationError(message)
 
@@ -46,6 +52,80 @@ class IsMeetingMemberValidator(object):
         self.user = serializer_field.parent.context['request'].user
 
 
+# ~~~~~~~~ Fields ~~~~~~~~ #
+
+
+class BulkManyRelatedField(serializers.ManyRelatedField):
+    """ManyRelatedField that looks up all the submitted pks in one query instead of one query per pk."""
+
+    def to_internal_value(self, data):
+        if isinstance(data, str) or not hasattr(data, '__iter__'):
+            self.fail('not_a_list', input_type=type(data).__name__)
+        if not self.allow_empty and len(data) == 0:
+            self.fail('empty')
+        child = self.child_relation
+        for pk in data:
+            if isinstance(pk, (bool, dict, list)):
+                child.fail('incorrect_type', data_type=type(pk).__name__)
+        try:
+            objects = {str(pk): obj for pk, obj in child.get_queryset().in_bulk(data).items()}
+        except (TypeError, ValueError):
+            child.fail('incorrect_type', data_type=type(data[0]).__name__)
+        for pk in data:
+            if str(pk) not in objects:
+                child.fail('does_not_exist', pk_value=pk)
+        return [objects[str(pk)] for pk in data]
+
+
+class BulkPrimaryKeyRelatedField(serializers.PrimaryKeyRelatedField):
+    """PrimaryKeyRelatedField whose many=True form validates its pks in one query (see BulkManyRelatedField)."""
+
+    @classmethod
+    def many_init(cls, *args, **kwargs):
+        list_kwargs = {'child_relation': cls(*args, **kwargs)}
+        for key in kwargs.keys():
+            if key in MANY_RELATION_KWARGS:
+                list_kwargs[key] = kwargs[key]
+        return BulkManyRelatedField(**list_kwargs)
+
+
+# ~~~~~~~~ Mixins ~~~~~~~~ #
+
+
+class CompactCreatorMixin(object):
+    """Serializes the creator as a plain id when the view asks for compact output (see CompactUsersMixin)."""
+
+    def get_fields(self):
+        fields = super().get_fields()
+        if self.context.get('compact'):
+            fields['creator'] = serializers.PrimaryKeyRelatedField(read_only=True)
+        return fields
+
+
+class SparseFieldsMixin(object):
+    """Honors the `fields` and `expand` sets the view puts in the context (see views.SparseFieldsMixin).
+
+    `fields` limits the top-level fields; nested serializers are left alone. When `expand` is given, relations listed in
+    Meta.expandable_fields but not in `expand` are serialized as ids instead of nested objects.
+    """
+
+    def get_fields(self):
+        fields = super().get_fields()
+        parent = self.parent.parent if isinstance(self.parent, serializers.ListSerializer) else self.parent
+        if parent is not None:
+            return fields
+        requested = self.context.get('fields')
+        if requested is not None:
+            fields = OrderedDict((name, field) for name, field in fields.items() if name in requested)
+        expand = self.context.get('expand')
+        if expand is not None:
+            for name in getattr(self.Meta, 'expandable_fields', ()):
+                if name in fields and name not in expand:
+                    many = isinstance(fields[name], serializers.ListSerializer)
+                    fields[name] = serializers.PrimaryKeyRelatedField(read_only=True, many=many)
+        return fields
+
+
 # ~~~~~~~~ Serializers ~~~~~~~~ #
 
 
@@ -60,7 +140,7 @@ class UserProfileSerializer(serializers.ModelSerializer):
         fields = ()
 
 
-class UserSerializer(serializers.ModelSerializer):
+class UserSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     profile = UserProfileSerializer(required=False)
 
     def __init__(self, *args, **kwargs):
@@ -96,7 +176,7 @@ class UserSerializer(serializers.ModelSerializer):
         return instance
 
 
-class TermSerializer(serializers.ModelSerializer):
+class TermSerializer(SparseFieldsMixin, serializers.ModelSerializer):
 
     def __init__(self, *args, **kwargs):
         many = kwargs.pop('many', True)
@@ -107,7 +187,8 @@ class TermSerializer(serializers.ModelSerializer):
         fields = ('id', 'name', 'code', 'start_date', 'end_date', 'subjects_loaded')
 
 
-class SubjectSerializer(serializers.ModelSerializer):
+class SubjectSerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    term = TermSerializer(many=False, read_only=True)
 
     def __init__(self, *args, **kwargs):
         many = kwargs.pop('many', True)
@@ -116,7 +197,7 @@ class SubjectSerializer(serializers.ModelSerializer):
     class Meta:
         model = Subject
         fields = ('id', 'name', 'code', 'term', 'courses_loaded')
-        depth = 1
+        expandable_fields = ('term',)
 
 
 class SectionSerializer(serializers.ModelSerializer):
@@ -141,7 +222,7 @@ class MeetingTimeSerializer(serializers.ModelSerializer):
         fields = ('meet_days', 'start_time', 'end_time')
 
 
-class CourseSerializer(serializers.ModelSerializer):
+class CourseSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     sections = SectionSerializer(many=True)
     meeting_times = MeetingTimeSerializer(many=True)
     members = serializers.PrimaryKeyRelatedField(queryset=UserProfile.objects.all(), many=True)
@@ -153,13 +234,14 @@ class CourseSerializer(serializers.ModelSerializer):
     class Meta:
         model = Course
         fields = ('id', 'name', 'subject', 'course_number', 'sections', 'meeting_times', 'is_cancelled', 'members')
+        expandable_fields = ('subject', 'sections', 'meeting_times')
         depth = 1
 
 
-class GroupSerializer(serializers.ModelSerializer):
+class GroupSerializer(SparseFieldsMixin, CompactCreatorMixin, serializers.ModelSerializer):
     course = serializers.PrimaryKeyRelatedField(queryset=Course.objects.all(), validators=[IsCourseMemberValidator()])
     creator = UserSerializer(read_only=True)
-    members = serializers.PrimaryKeyRelatedField(queryset=User.objects.all(), many=True, required=False) # TODO: validate is course member
+    members = BulkPrimaryKeyRelatedField(queryset=User.objects.all(), many=True, required=False) # TODO: validate is course member
     # members_data = UserSerializer(source='members', many=True, read_only=True)  # TODO: slow performance
 
     def __init__(self, *args, **kwargs):
@@ -184,7 +266,7 @@ class GroupSerializer(serializers.ModelSerializer):
         notification.save()
         notification.recipients.add(*group_members)
         notification.recipients.remove(group.creator)
-        notification.broadcast()
+        transaction.on_commit(notification.broadcast)
         return group
 
     def update(self, instance, validated_data):
@@ -194,10 +276,10 @@ class GroupSerializer(serializers.ModelSerializer):
         return instance
 
 
-class MeetingSerializer(serializers.ModelSerializer):
+class MeetingSerializer(SparseFieldsMixin, CompactCreatorMixin, serializers.ModelSerializer):
     course = serializers.PrimaryKeyRelatedField(queryset=Course.objects.all(), validators=[IsCourseMemberValidator()])
     creator = UserSerializer(read_only=True)
-    members = serializers.PrimaryKeyRelatedField(queryset=User.objects.all(), many=True, required=False) # TODO: validate is course member
+    members = BulkPrimaryKeyRelatedField(queryset=User.objects.all(), many=True, required=False) # TODO: validate is course member
     # members_data = UserSerializer(source='members', many=True, read_only=True)  # TODO: slow performance
 
     def __init__(self, *args, **kwargs):
@@ -223,12 +305,12 @@ class MeetingSerializer(serializers.ModelSerializer):
         notification.save()
         notification.recipients.add(*meeting_members)
         notification.recipients.remove(meeting.creator)
-        notification.broadcast()
+        transaction.on_commit(notification.broadcast)
         invitation = MeetingInvitation(meeting=meeting, creator=meeting.creator)
         invitation.save()
         invitation.recipients.add(*course_members)
         invitation.recipients.remove(*meeting_members)
-        invitation.broadcast()
+        transaction.on_commit(invitation.broadcast)
         return meeting
 
     def update(self, instance, validated_data):
@@ -240,9 +322,9 @@ class MeetingSerializer(serializers.ModelSerializer):
         return instance
 
 
-class StandardNotificationSerializer(serializers.ModelSerializer):
+class StandardNotificationSerializer(SparseFieldsMixin, CompactCreatorMixin, serializers.ModelSerializer):
     creator = UserSerializer(read_only=True)
-    recipients = serializers.PrimaryKeyRelatedField(queryset=User.objects.all(), many=True)
+    recipients = BulkPrimaryKeyRelatedField(queryset=User.objects.all(), many=True)
 
     def __init__(self, *args, **kwargs):
         many = kwargs.pop('many', True)
@@ -259,14 +341,14 @@ class StandardNotificationSerializer(serializers.ModelSerializer):
         notification.creator = self.context['request'].user
         notification.save()
         notification.recipients.add(*recipients)
-        notification.broadcast()
+        transaction.on_commit(notification.broadcast)
         return notification
 
 
-class GroupNotificationSerializer(serializers.ModelSerializer):
-    group = serializers.PrimaryKeyRelatedField(queryset=Group.objects.all(), validators=[IsGroupMemberValidator()])
+class GroupNotificationSerializer(SparseFieldsMixin, CompactCreatorMixin, serializers.ModelSerializer):
+    group = serializers.PrimaryKeyRelatedField(queryset=Group.objects.select_related('course__subject'), validators=[IsGroupMemberValidator()])
     creator = UserSerializer(read_only=True)
-    recipients = serializers.PrimaryKeyRelatedField(queryset=User.objects.all(), many=True)
+    recipients = BulkPrimaryKeyRelatedField(queryset=User.objects.all(), many=True)
 
     def __init__(self, *args, **kwargs):
         many = kwargs.pop('many', True)
@@ -283,14 +365,14 @@ class GroupNotificationSerializer(serializers.ModelSerializer):
         notification.creator = self.context['request'].user
         notification.save()
         notification.recipients.add(*recipients)
-        notification.broadcast()
+        transaction.on_commit(notification.broadcast)
         return notification
 
 
-class MeetingNotificationSerializer(serializers.ModelSerializer):
-    meeting = serializers.PrimaryKeyRelatedField(queryset=Meeting.objects.all(), validators=[IsMeetingMemberValidator()])
+class MeetingNotificationSerializer(SparseFieldsMixin, CompactCreatorMixin, serializers.ModelSerializer):
+    meeting = serializers.PrimaryKeyRelatedField(queryset=Meeting.objects.select_related('course__subject'), validators=[IsMeetingMemberValidator()])
     creator = UserSerializer(read_only=True)
-    recipients = serializers.PrimaryKeyRelatedField(queryset=User.objects.all(), many=True)
+    recipients = BulkPrimaryKeyRelatedField(queryset=User.objects.all(), many=True)
 
     def __init__(self, *args, **kwargs):
         many = kwargs.pop('many', True)
@@ -307,14 +389,14 @@ class MeetingNotificationSerializer(serializers.ModelSerializer):
         notification.creator = self.context['request'].user
         notification.save()
         notification.recipients.add(*recipients)
-        notification.broadcast()
+        transaction.on_commit(notification.broadcast)
         return notification
 
 
-class GroupInvitationSerializer(serializers.ModelSerializer):
-    group = serializers.PrimaryKeyRelatedField(queryset=Group.objects.all(), validators=[IsGroupMemberValidator()])
+class GroupInvitationSerializer(SparseFieldsMixin, CompactCreatorMixin, serializers.ModelSerializer):
+    group = serializers.PrimaryKeyRelatedField(queryset=Group.objects.select_related('course__subject'), validators=[IsGroupMemberValidator()])
     creator = UserSerializer(read_only=True)
-    recipients = serializers.PrimaryKeyRelatedField(queryset=User.objects.all(), many=True)
+    recipients = BulkPrimaryKeyRelatedField(queryset=User.objects.all(), many=True)
 
     def __init__(self, *args, **kwargs):
         many = kwargs.pop('many', True)
@@ -331,14 +413,14 @@ class GroupInvitationSerializer(serializers.ModelSerializer):
         notification.creator = self.context['request'].user
         notification.save()
         notification.recipients.add(*recipients)
-        notification.broadcast()
+        transaction.on_commit(notification.broadcast)
         return notification
 
 
-class MeetingInvitationSerializer(serializers.ModelSerializer):
-    meeting = serializers.PrimaryKeyRelatedField(queryset=Meeting.objects.all(), validators=[IsMeetingMemberValidator()])
+class MeetingInvitationSerializer(SparseFieldsMixin, CompactCreatorMixin, serializers.ModelSerializer):
+    meeting = serializers.PrimaryKeyRelatedField(queryset=Meeting.objects.select_related('course__subject'), validators=[IsMeetingMemberValidator()])
     creator = UserSerializer(read_only=True)
-    recipients = serializers.PrimaryKeyRelatedField(queryset=User.objects.all(), many=True)
+    recipients = BulkPrimaryKeyRelatedField(queryset=User.objects.all(), many=True)
 
     def __init__(self, *args, **kwargs):
         many = kwargs.pop('many', True)
@@ -355,12 +437,12 @@ class MeetingInvitationSerializer(serializers.ModelSerializer):
         notification.creator = self.context['request'].user
         notification.save()
         notification.recipients.add(*recipients)
-        notification.broadcast()
+        transaction.on_commit(notification.broadcast)
         return notification
 
 
-class MeetingProposalSerializer(serializers.ModelSerializer):
-    meeting = serializers.PrimaryKeyRelatedField(queryset=Meeting.objects.all(), validators=[IsMeetingMemberValidator()])
+class MeetingProposalSerializer(SparseFieldsMixin, CompactCreatorMixin, serializers.ModelSerializer):
+    meeting = serializers.PrimaryKeyRelatedField(queryset=Meeting.objects.select_related('course__subject'), validators=[IsMeetingMemberValidator()])
     creator = UserSerializer(read_only=True)
 
     def __init__(self, *args, **kwargs):
@@ -379,8 +461,8 @@ class MeetingProposalSerializer(serializers.ModelSerializer):
         return meeting_proposal
 
 
-class MeetingProposalResultSerializer(serializers.ModelSerializer):
-    meeting = serializers.PrimaryKeyRelatedField(queryset=Meeting.objects.all(), validators=[IsMeetingMemberValidator()])
+class MeetingProposalResultSerializer(SparseFieldsMixin, CompactCreatorMixin, serializers.ModelSerializer):
+    meeting = serializers.PrimaryKeyRelatedField(queryset=Meeting.objects.select_related('course__subject'), validators=[IsMeetingMemberValidator()])
     creator = UserSerializer(read_only=True)
 
     def __init__(self, *args, **kwargs):
@@ -388,13 +470,13 @@ class MeetingProposalResultSerializer(serializers.ModelSerializer):
         super().__init__(many=many, *args, **kwargs)
 
     class Meta:
-        model = MeetingProposal
+        model = MeetingProposalResult
         fields = ('id', 'meeting_proposal', 'meeting', 'title', 'message', 'message_expanded', 'creator', 'recipients', 'recipients_read_by', 'timestamp')
         read_only_fields = ('creator', 'title', 'message', 'message_expanded', 'recipients', 'recipients_read_by', 'timestamp')
 
 
-class CourseMessageSerializer(serializers.ModelSerializer):
-    course = serializers.PrimaryKeyRelatedField(queryset=Course.objects.all(), validators=[IsCourseMemberValidator()])
+class CourseMessageSerializer(SparseFieldsMixin, CompactCreatorMixin, serializers.ModelSerializer):
+    course = serializers.PrimaryKeyRelatedField(queryset=Course.objects.select_related('subject__term'), validators=[IsCourseMemberValidator()])
     creator = UserSerializer(read_only=True)
 
     def __init__(self, *args, **kwargs):
@@ -406,6 +488,11 @@ class CourseMessageSerializer(serializers.ModelSerializer):
         fields = ('id', 'content', 'course', 'creator', 'timestamp')
         read_only_fields = ('creator', 'timestamp')
 
+    def validate_course(self, course):
+        if course.subject.term.messages_archived:
+            raise serializers.ValidationError('Course has ended')
+        return course
+
     def create(self, validated_data):
         course_message = CourseMessage(**validated_data)
         course_message.creator = self.context['request'].user
@@ -413,8 +500,8 @@ class CourseMessageSerializer(serializers.ModelSerializer):
         return course_message
 
 
-class GroupMessageSerializer(serializers.ModelSerializer):
-    group = serializers.PrimaryKeyRelatedField(queryset=Group.objects.all(), validators=[IsGroupMemberValidator()])
+class GroupMessageSerializer(SparseFieldsMixin, CompactCreatorMixin, serializers.ModelSerializer):
+    group = serializers.PrimaryKeyRelatedField(queryset=Group.objects.select_related('course__subject__term'), validators=[IsGroupMemberValidator()])
     creator = UserSerializer(read_only=True)
 
     def __init__(self, *args, **kwargs):
@@ -426,15 +513,19 @@ class GroupMessageSerializer(serializers.ModelSerializer):
         fields = ('id', 'content', 'group', 'creator', 'timestamp')
         read_only_fields = ('creator', 'timestamp')
 
+    def validate_group(self, group):
+        if group.course.subject.term.messages_archived:
+            raise serializers.ValidationError('Course has ended')
+        return group
+
     def create(self, validated_data):
-        print(str(validated_data))
         group_message = GroupMessage(**validated_data)
         group_message.creator = self.context['request'].user
         group_message.save()
         return group_message
 
 
-class ServerStateSerializer(serializers.ModelSerializer):
+class ServerStateSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     term_progress = serializers.SerializerMethodField()
     subjects_progress = serializers.SerializerMethodField()
     courses_progress = serializers.SerializerMethodField()
@@ -465,4 +556,127 @@ class ServerStateSerializer(serializers.ModelSerializer):
         return progress
 
 
+class MemberIdsSerializer(serializers.Serializer):
+    members = serializers.ListField(child=serializers.IntegerField(), allow_empty=False)
+
+
+# ~~~~~~~~ Fast list serializers ~~~~~~~~ #
+
+
+def _date(value):
+    return value.isoformat() if value else None
+
+
+def _time(value):
+    return value.isoformat() if value not in (None, '') else None
+
+
+def _datetime(value):
+    if not value:
+        return None
+    if timezone.is_naive(value):
+        value = timezone.make_aware(value)
+    value = value.isoformat()
+    return value[:-6] + 'Z' if value.endswith('+00:00') else value
+
+
+def _group_by_first(rows):
+    groups = {}
+    for row in rows:
+        groups.setdefault(row[0], []).append(row[1:])
+    return groups
+
+
+class FastListSerializer(object):
+    """Read-only list output built straight from values_list() tuples, without DRF's per-field machinery.
+
+    `columns` are the lookups read for each object and `row` turns one tuple of them into the same data the regular
+    serializer produces for the default representation (no fields, expand or compact). See views.FastListMixin.
+    """
+    columns = ()
+
+    def prepare(self, queryset):
+        return queryset.select_related(None).prefetch_related(None).values_list(*self.columns)
+
+    def serialize(self, rows):
+        row = self.row
+        return [row(*values) for values in rows]
+
+
+class TermFastSerializer(FastListSerializer):
+    columns = ('id', 'name', 'code', 'start_date', 'end_date', 'subjects_loaded')
+
+    @staticmethod
+    def row(id, name, code, start_date, end_date, subjects_loaded):
+        return {'id': id, 'name': name, 'code': code, 'start_date': _date(start_date), 'end_date': _date(end_date),
+                'subjects_loaded': subjects_loaded}
+
+
+class SubjectFastSerializer(FastListSerializer):
+    columns = ('id', 'name', 'code', 'courses_loaded') + tuple('term__' + c for c in TermFastSerializer.columns)
+
+    @staticmethod
+    def row(id, name, code, courses_loaded, *term):
+        return {'id': id, 'name': name, 'code': code, 'term': TermFastSerializer.row(*term), 'courses_loaded': courses_loaded}
+
+
+class CourseFastSerializer(FastListSerializer):
+    columns = ('id', 'name', 'subject_id', 'subject__name', 'subject__code', 'subject__courses_loaded', 'subject__term_id',
+               'course_number', 'is_cancelled')
+
+    def serialize(self, rows):
+        rows = list(rows)
+        ids = [values[0] for values in rows]
+        self.sections = _group_by_first(Course.sections.through.objects.filter(course_id__in=ids)
+                                        .order_by('section__name').values_list('course_id', 'section__name'))
+        self.meeting_times = _group_by_first(MeetingTime.objects.filter(course_id__in=ids)
+                                             .order_by('pk').values_list('course_id', 'meet_days', 'start_time', 'end_time'))
+        self.members = _group_by_first(Course.members.through.objects.filter(course_id__in=ids)
+                                       .order_by('user_id').values_list('course_id', 'user_id'))
+        return super().serialize(rows)
+
+    def row(self, id, name, subject_id, subject_name, subject_code, subject_courses_loaded, subject_term_id, course_number,
+            is_cancelled):
+        return {
+            'id': id,
+            'name': name,
+            'subject': {'id': subject_id, 'name': subject_name, 'code': subject_code,
+                        'courses_loaded': subject_courses_loaded, 'term': subject_term_id},
+            'course_number': course_number,
+            'sections': [{'name': s[0]} for s in self.sections.get(id, ())],
+            'meeting_times': [{'meet_days': m[0], 'start_time': _time(m[1]), 'end_time': _time(m[2])}
+                              for m in self.meeting_times.get(id, ())],
+            'is_cancelled': is_cancelled,
+            'members': [m[0] for m in self.members.get(id, ())],
+        }
+
+
+class UserFastSerializer(FastListSerializer):
+    columns = ('id', 'username', 'first_name', 'last_name', 'email', 'profile__id')
+
+    @staticmethod
+    def row(id, username, first_name, last_name, email, profile_id):
+        if id is None:
+            return None
+        user = {'id': id, 'username': username, 'first_name': first_name, 'last_name': last_name, 'email': email}
+        if profile_id is not None:
+            user['profile'] = {}
+        return user
+
+
+class CourseMessageFastSerializer(FastListSerializer):
+    columns = ('id', 'content', 'course_id', 'timestamp') + tuple('creator__' + c for c in UserFastSerializer.columns)
+
+    @staticmethod
+    def row(id, content, course_id, timestamp, *creator):
+        return {'id': id, 'content': content, 'course': course_id, 'creator': UserFastSerializer.row(*creator),
+                'timestamp': _datetime(timestamp)}
+
+
+class GroupMessageFastSerializer(FastListSerializer):
+    columns = ('id', 'content', 'group_id', 'timestamp') + tuple('creator__' + c for c in UserFastSerializer.columns)
 
+    @staticmethod
+    def row(id, content, group_id, timestamp, *creator):
+        return {'id': id, 'content': content, 'group': group_id, 'creator': UserFastSerializer.row(*creator),
+                'timestamp': _datetime(timestamp)}
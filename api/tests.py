@@ -1,3 +1,506 @@
-from django.test import TestCase
+import io
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+from datetime import date, time, timedelta
+from urllib.error import URLError
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import IntegrityError, connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from push_notifications.gcm import GCMError
+from push_notifications.models import GCMDevice
+from rest_framework.test import APIClient
+
+from .log import QueueHandler, RequestIdFilter, set_request_id
+from .metrics import DB_QUERIES, PUSH_MESSAGES, registry
+from .models import *
+from .serializers import TermSerializer
+
+
+def results(response):
+    """The rows of a list response, paginated or not."""
+    return response.data['results'] if isinstance(response.data, dict) else response.data
+
+
+class SubjectTermFieldsTest(TestCase):
+    """Internal Term flags (retired, messages_archived) must not leak into the nested terms of subjects."""
+
+    def setUp(self):
+        today = date.today()
+        self.term = Term.objects.create(name='Fall', code='201708', start_date=today - timedelta(days=10),
+                                        end_date=today + timedelta(days=60))
+        Subject.objects.create(name='Computer Science', code='CS', term=self.term)
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user('student', password='password'))
+
+    def test_nested_term_fields(self):
+        for params in ({}, {'expand': 'term'}):  # fast and regular list paths
+            response = self.client.get('/api/subjects/', params)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(list(results(response)[0]['term']), list(TermSerializer.Meta.fields))
+        response = self.client.get('/api/subjects/' + str(self.term.subjects.get().pk) + '/')
+        self.assertEqual(list(response.data['term']), list(TermSerializer.Meta.fields))
+
+
+class ReplicaSettingsTest(SimpleTestCase):
+    """Replica pins live in the cache, so replicas without a cache shared by all workers are refused at startup."""
+
+    def check(self, **environ):
+        env = dict(os.environ, DATABASE_REPLICA_URLS='sqlite:///' + os.path.join(tempfile.gettempdir(), 'replica.sqlite3'))
+        env.pop('MEMCACHED_LOCATION', None)
+        env.update(environ)
+        return subprocess.run([sys.executable, 'manage.py', 'check'], cwd=settings.BASE_DIR, env=env,
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+
+    def test_requires_shared_cache(self):
+        result = self.check()
+        self.assertNotEqual(result.returncode, 0)
+        self.assertIn('MEMCACHED_LOCATION', result.stderr)
+        self.assertEqual(self.check(MEMCACHED_LOCATION='127.0.0.1:11211').returncode, 0)
+
+
+class SparseFieldsTest(TestCase):
+    """`fields` and `expand` reshape reads only; writes validate and save every writable field."""
+
+    def setUp(self):
+        today = date.today()
+        term = Term.objects.create(name='Fall', code='201708', start_date=today, end_date=today + timedelta(days=60))
+        self.course = Course.objects.create(subject=Subject.objects.create(code='CS', term=term), course_number='1331')
+        user = User.objects.create_user('student')
+        self.course.members.add(user)
+        self.client = APIClient()
+        self.client.force_authenticate(user)
+
+    def test_write_ignores_fields(self):
+        response = self.client.post('/api/groups/?fields=id&expand=members', {'name': 'Study', 'course': self.course.pk}, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual((response.data['name'], response.data['course']), ('Study', self.course.pk))
+        response = self.client.get('/api/groups/' + str(response.data['id']) + '/?fields=id')
+        self.assertEqual(list(response.data), ['id'])
+
+
+class ConditionalTest(TestCase):
+    """Lists are answered with 304 only for a matching ETag; If-Modified-Since can't see changes within one second."""
+
+    def setUp(self):
+        today = date.today()
+        term = Term.objects.create(name='Fall', code='201708', start_date=today, end_date=today + timedelta(days=60))
+        self.course = Course.objects.create(subject=Subject.objects.create(code='CS', term=term), course_number='1331')
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user('student'))
+
+    def test_etag(self):
+        Group.objects.create(name='Study', course=self.course)
+        response = self.client.get('/api/groups/')
+        etag, last_modified = response['ETag'], response['Last-Modified']
+        self.assertEqual(self.client.get('/api/groups/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        Group.objects.create(name='Review', course=self.course)  # most likely within the same second
+        response = self.client.get('/api/groups/', HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual((response.status_code, len(results(response))), (200, 2))
+        response = self.client.get('/api/groups/', HTTP_IF_NONE_MATCH=etag, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+
+class MembershipTest(TestCase):
+    """Membership checks see joins and leaves made by other workers, whose signals only clear their own process."""
+
+    def setUp(self):
+        today = date.today()
+        term = Term.objects.create(name='Fall', code='201708', start_date=today, end_date=today + timedelta(days=60))
+        course = Course.objects.create(subject=Subject.objects.create(code='CS', term=term), course_number='1331')
+        self.user = User.objects.create_user('student')
+        course.members.add(self.user)
+        self.group = Group.objects.create(name='Study', course=course)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.user.auth_token.key)  # a fresh user object per request
+
+    def post_message(self):
+        return self.client.post('/api/group-messages/', {'group': self.group.pk, 'content': 'Hi'}, format='json').status_code
+
+    def test_changes_behind_the_cache(self):
+        through = Group.members.through
+        self.assertEqual(self.post_message(), 400)  # loads the sets
+        through.objects.bulk_create([through(group_id=self.group.pk, user_id=self.user.pk)])  # sends no m2m_changed
+        self.assertEqual(self.post_message(), 201)
+        through.objects.filter(group_id=self.group.pk).delete()
+        self.assertEqual(self.post_message(), 400)
+
+    def mine(self):
+        response = self.client.get('/api/groups/mine/')
+        self.assertEqual(response.status_code, 200)
+        return [group['id'] for group in results(response)]
+
+    def test_mine_behind_the_cache(self):
+        through = Group.members.through
+        self.assertEqual(self.mine(), [])
+        through.objects.bulk_create([through(group_id=self.group.pk, user_id=self.user.pk)])  # sends no m2m_changed
+        self.assertEqual(self.mine(), [self.group.pk])
+        through.objects.filter(group_id=self.group.pk).delete()
+        self.assertEqual(self.mine(), [])
+
+    def test_mine_shared_cache(self):
+        cache.clear()
+        with override_settings(SHARED_CACHE=True):  # the local-memory cache stands in for memcached in one process
+            self.assertEqual(self.mine(), [])
+            self.assertIsNotNone(cache.get('member_ids:groups:' + str(self.user.pk)))
+            self.assertEqual(self.client.post('/api/groups/' + str(self.group.pk) + '/join/').status_code, 200)
+            self.assertEqual(self.mine(), [self.group.pk])
+            self.assertEqual(self.client.post('/api/groups/' + str(self.group.pk) + '/leave/').status_code, 200)
+            self.assertEqual(self.mine(), [])
+        cache.clear()
+
+
+class FastListSerializersTest(TestCase):
+    """The fast list path (api.views.FastListMixin) must render exactly the bytes the regular serializers render."""
+    urls = ('/api/terms/', '/api/subjects/', '/api/courses/', '/api/course-messages/', '/api/group-messages/')
+
+    def setUp(self):
+        today = date.today()
+        student = User.objects.create_user('student', first_name='Ana', last_name='Lee', email='ana@example.com')
+        other = User.objects.create_user('other')
+        term = Term.objects.create(name='Fall', code='201708', start_date=today - timedelta(days=10),
+                                   end_date=today + timedelta(days=60), subjects_loaded=True)
+        subject = Subject.objects.create(name='Computer Science', code='CS', term=term, courses_loaded=True)
+        for number, cancelled in (('1331', False), ('1332', True)):
+            course = Course.objects.create(name='Course ' + number, subject=subject, course_number=number, is_cancelled=cancelled)
+            course.sections.add(Section.objects.create(name='A'), Section.objects.create(name='B1'))
+            MeetingTime.objects.create(course=course, meet_days='MWF', start_time='09:05', end_time='09:55')
+            MeetingTime.objects.create(course=course, meet_days='TR')
+            course.members.add(student, other)
+            CourseMessage.objects.create(course=course, creator=student, content='Hello "' + number + '" \u00e9')
+            CourseMessage.objects.create(course=course, creator=None, content='')
+            group = Group.objects.create(name='Study ' + number, course=course, creator=student)
+            group.members.add(student)
+            GroupMessage.objects.create(group=group, creator=other, content='Hi')
+            GroupMessage.objects.create(group=group, creator=None, content='Bye')
+        self.client = APIClient()
+        self.client.force_authenticate(student)
+
+    def test_identical_output(self):
+        for url in self.urls:
+            fast = self.client.get(url)
+            with override_settings(FAST_LIST_SERIALIZERS=False):
+                regular = self.client.get(url)
+            self.assertEqual(fast.status_code, 200, url)
+            self.assertTrue(results(fast), url)
+            self.assertEqual(fast.content, regular.content, url)
+
+
+class ConcurrentApproveTest(TransactionTestCase):
+    """Votes on one proposal from many threads at once: each voter counts once, and it is applied exactly once."""
+    voters = 8
+
+    def setUp(self):
+        today = date.today()
+        term = Term.objects.create(name='Fall', code='201708', start_date=today, end_date=today + timedelta(days=60))
+        course = Course.objects.create(subject=Subject.objects.create(code='CS', term=term), course_number='1331')
+        self.creator = User.objects.create_user('creator', first_name='Ana')
+        self.users = [User.objects.create_user('voter' + str(i)) for i in range(self.voters)]
+        meeting = Meeting.objects.create(name='Study', location='Library', start_date=today, start_time=time(9),
+                                         course=course, creator=self.creator)
+        meeting.members.add(self.creator, *self.users)
+        self.proposal = MeetingProposal.objects.create(meeting=meeting, creator=self.creator, title='Change',
+                                                       location='CULC', start_date=today, start_time=time(10))
+        self.proposal.recipients.add(*self.users)
+
+    def vote(self, user, barrier, statuses):
+        client = APIClient()
+        client.force_authenticate(user)
+        try:
+            barrier.wait()
+            for _ in range(2):  # a repeated vote must not count twice
+                statuses.append(client.post('/api/meeting-proposals/' + str(self.proposal.pk) + '/approve/').status_code)
+        finally:
+            connection.close()
+
+    def test_concurrent_votes(self):
+        barrier = threading.Barrier(self.voters)
+        statuses = []
+        with mock.patch.object(MeetingProposal, 'apply', autospec=True, side_effect=MeetingProposal.apply) as apply:
+            threads = [threading.Thread(target=self.vote, args=(user, barrier, statuses)) for user in self.users]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(statuses, [200] * self.voters * 2)
+        proposal = MeetingProposal.objects.get(pk=self.proposal.pk)
+        self.assertEqual(proposal.responses_count, proposal.responses_received.count())
+        self.assertEqual(proposal.responses_count, self.voters)
+        self.assertTrue(proposal.closed and proposal.applied)
+        self.assertEqual(apply.call_count, 1)
+        self.assertEqual(MeetingProposalResult.objects.filter(meeting_proposal=proposal).count(), 1)
+        self.assertEqual(Meeting.objects.get(pk=proposal.meeting_id).location, 'CULC')
+
+
+class CloseExpiredTest(TestCase):
+    """The expiry sweep closes each open proposal once, survives deleted creators and records the result recipients."""
+
+    def setUp(self):
+        today = date.today()
+        term = Term.objects.create(name='Fall', code='201708', start_date=today, end_date=today + timedelta(days=60))
+        course = Course.objects.create(subject=Subject.objects.create(code='CS', term=term), course_number='1331')
+        self.creator = User.objects.create_user('creator', first_name='Ana')
+        self.member = User.objects.create_user('member')
+        self.meeting = Meeting.objects.create(name='Study', location='Library', start_date=today, start_time=time(9),
+                                              course=course, creator=self.creator)
+        self.meeting.members.add(self.creator, self.member)
+
+    def propose(self, creator, **kwargs):
+        return MeetingProposal.objects.create(meeting=self.meeting, creator=creator, title='Change', location='CULC',
+                                              expires_at=timezone.now() - timedelta(minutes=1), **kwargs)
+
+    def test_close_expired(self):
+        orphaned = self.propose(User.objects.create_user('gone', first_name='Bo'))
+        orphaned.creator.delete()
+        proposal = self.propose(self.creator)
+        self.propose(self.creator, closed=True)
+        self.propose(self.creator).approve_by(self.member)  # the last vote applies it
+
+        results = MeetingProposal.close_expired()
+        self.assertEqual(sorted(r.meeting_proposal_id for r in results), [orphaned.pk, proposal.pk])
+        self.assertEqual(MeetingProposal.close_expired(), [])
+        self.assertTrue(MeetingProposal.objects.get(pk=orphaned.pk).closed)
+        for result in results:
+            result = MeetingProposalResult.objects.get(pk=result.pk)
+            self.assertEqual(set(result.recipients.all()), {self.creator, self.member})
+            # logged once its recipients were added, so sync reports it to them
+            entries = ChangeLogEntry.objects.filter(collection='api.notification', object_id=result.pk)
+            self.assertEqual(set(entries.values_list('user_id', flat=True)), {self.creator.pk, self.member.pk})
+        self.assertEqual(MeetingProposalResult.objects.get(meeting_proposal=orphaned).get_payload()['creator_first_name'], '')
+
+
+class NotificationPayloadTest(TestCase):
+    """Push payloads are built before the INSERT, from the relations already loaded, and read back without queries."""
+
+    def test_payload_built_on_insert(self):
+        today = date.today()
+        term = Term.objects.create(name='Fall', code='201708', start_date=today, end_date=today + timedelta(days=60))
+        course = Course.objects.create(subject=Subject.objects.create(code='CS', term=term), course_number='1331')
+        creator = User.objects.create_user('creator', first_name='Ana')
+        group = Group.objects.select_related('course__subject').get(pk=Group.objects.create(name='Study', course=course).pk)
+        with CaptureQueriesContext(connection) as queries:
+            notification = GroupInvitation(group=group, creator=creator)
+            notification.save()
+        self.assertFalse([q['sql'] for q in queries if q['sql'].startswith('UPDATE "api_notification"') or 'api_course' in q['sql']])
+        with self.assertNumQueries(0):
+            data = notification.get_payload()
+        self.assertEqual((data['id'], data['type'], data['group_id']), (notification.pk, GROUP_INVITATION, group.pk))
+        self.assertEqual((data['creator_first_name'], data['course_short_name']), ('Ana', 'CS 1331'))
+        self.assertEqual(Notification.objects.get(pk=notification.pk).get_payload(), data)
+
+
+class SyncTest(TestCase):
+    """Deleted notifications are reported to their recipients and creator, whose rows are gone by then."""
+
+    def setUp(self):
+        self.creator = User.objects.create_user('creator', first_name='Ana')
+        self.recipient = User.objects.create_user('recipient')
+        self.other = User.objects.create_user('other')
+        self.notification = StandardNotification.objects.create(creator=self.creator, title='Title', message='Message')
+        self.notification.recipients.add(self.recipient)
+
+    def sync(self, user, since):
+        client = APIClient()
+        client.force_authenticate(user)
+        with override_settings(SYNC_SETTLE_SECONDS=0):
+            response = client.get('/api/sync/', {'since': since})
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_delete_then_sync(self):
+        since = str(ChangeLogEntry.objects.aggregate(seq=Max('seq'))['seq'])
+        pk = self.notification.pk
+        for user in (self.creator, self.recipient):
+            self.assertEqual(self.sync(user, '0')['changed']['standard_notifications'][0]['id'], pk)
+        self.notification.delete()
+        for user in (self.creator, self.recipient):
+            self.assertEqual(self.sync(user, since)['deleted'], {'notifications': [pk]})
+        self.assertEqual(self.sync(self.other, since)['deleted'], {})
+
+    def test_compact_keeps_each_users_entry(self):
+        self.notification.recipients.add(self.other)
+        ChangeLogEntry.compact()
+        entries = ChangeLogEntry.objects.filter(collection='api.notification', object_id=self.notification.pk)
+        self.assertEqual(sorted(entries.values_list('user_id', flat=True)), sorted([self.creator.pk, self.recipient.pk, self.other.pk]))
+
+
+class SendPushTest(TestCase):
+    """Pushes go out per application and chunk of tokens, and one failed request doesn't stop the others."""
+
+    def setUp(self):
+        self.users = [User.objects.create_user('user' + str(i)) for i in range(3)]
+        for i, user in enumerate(self.users):
+            GCMDevice.objects.create(user=user, registration_id='token' + str(i), cloud_message_type='FCM', application_id='app')
+        GCMDevice.objects.create(user=self.users[0], registration_id='other', cloud_message_type='FCM', application_id='other')
+
+    def test_chunks_and_errors(self):
+        sent = []
+
+        def send(registration_ids, data, cloud_type, application_id=None, **kwargs):
+            sent.append((application_id, registration_ids))
+            data.pop("message")  # like the real send, which builds the FCM payload by popping keys from data
+            if registration_ids == ['token0', 'token1']:
+                raise GCMError({'success': 1, 'failure': 1, 'canonical_ids': 0})
+            if application_id == 'other':
+                raise URLError('timed out')
+            return {'success': len(registration_ids), 'failure': 0, 'canonical_ids': 0}
+
+        before = registry.snapshot()[PUSH_MESSAGES.name]
+        with mock.patch('api.models.gcm_send_message', side_effect=send), \
+                mock.patch('api.models.get_manager') as manager, self.assertLogs('api.models', 'WARNING'):
+            manager.return_value.get_max_recipients.return_value = 2
+            send_push([user.pk for user in self.users], {'title': 'Title', 'message': 'Message'})
+        self.assertEqual(sorted(sent), [('app', ['token0', 'token1']), ('app', ['token2']), ('other', ['other'])])
+        after = registry.snapshot()[PUSH_MESSAGES.name]
+        self.assertEqual({labels: value - before.get(labels, 0) for labels, value in after.items()},
+                         {json.dumps(['sent']): 2, json.dumps(['failed']): 1, json.dumps(['error']): 1})
+
+
+class BatchTest(TransactionTestCase):
+    """Batches roll back as a whole, send pushes only after committing and turn database errors into 500 results."""
+
+    def setUp(self):
+        today = date.today()
+        term = Term.objects.create(name='Fall', code='201708', start_date=today, end_date=today + timedelta(days=60))
+        self.course = Course.objects.create(subject=Subject.objects.create(code='CS', term=term), course_number='1331')
+        self.user = User.objects.create_user('student', first_name='Ana')
+        self.friend = User.objects.create_user('friend')
+        self.course.members.add(self.user, self.friend)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def batch(self, *subrequests):
+        response = self.client.post('/api/batch/', list(subrequests), format='json')
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def create_group(self):
+        return {'method': 'POST', 'url': '/api/groups/',
+                'body': {'name': 'Study', 'course': self.course.pk, 'members': [self.friend.pk]}}
+
+    def test_push_after_commit(self):
+        with mock.patch.object(Notification, 'broadcast') as broadcast:
+            data = self.batch(self.create_group())
+        self.assertFalse(data['rolled_back'])
+        self.assertEqual(broadcast.call_count, 1)
+
+    def test_rollback_sends_no_push(self):
+        with mock.patch.object(Notification, 'broadcast') as broadcast:
+            data = self.batch(self.create_group(), {'url': '/api/groups/0/'})
+        self.assertEqual([r['status'] for r in data['results']], [201, 404])
+        self.assertTrue(data['rolled_back'])
+        self.assertFalse(Group.objects.exists())
+        self.assertEqual(broadcast.call_count, 0)
+
+    def test_database_error(self):
+        with mock.patch('api.serializers.GroupSerializer.create', side_effect=IntegrityError('duplicate')), \
+                self.assertLogs('api.views', 'ERROR'):
+            data = self.batch(self.create_group(), {'url': '/api/courses/'})
+        self.assertEqual([r['status'] for r in data['results']], [500, 200])
+        self.assertTrue(data['rolled_back'])
+
+
+class ProfilingTest(TestCase):
+    """Header-triggered profiling needs PROFILING_TOKEN, even with DEBUG on, and keeps PROFILING_MAX_DUMPS dumps."""
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_requires_token(self):
+        with override_settings(DEBUG=True, PROFILING_TOKEN='', PROFILING_DIR=self.dir.name):
+            response = self.client.get('/api/terms/', HTTP_X_PROFILE='1', HTTP_X_PROFILE_DUMP='1')
+        self.assertNotIn('Server-Timing', response)
+        self.assertEqual(os.listdir(self.dir.name), [])
+        with override_settings(PROFILING_TOKEN='secret'), self.assertLogs('api.middleware', 'INFO'):
+            self.assertNotIn('Server-Timing', self.client.get('/api/terms/', HTTP_X_PROFILE='wrong'))
+            self.assertIn('Server-Timing', self.client.get('/api/terms/', HTTP_X_PROFILE='secret'))
+
+    def test_dumps_capped(self):
+        with override_settings(PROFILING_TOKEN='secret', PROFILING_DIR=self.dir.name, PROFILING_MAX_DUMPS=2), \
+                self.assertLogs('api.middleware', 'INFO'):
+            for i in range(4):
+                self.client.get('/api/terms/?page=' + str(i), HTTP_X_PROFILE='secret', HTTP_X_PROFILE_DUMP='1')
+        self.assertEqual(len(os.listdir(self.dir.name)), 2)
+
+
+class MetricsTest(TestCase):
+    """/metrics adds up the files of live processes and folds those of exited ones into a total, counting each once."""
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.settings = override_settings(METRICS_DIR=self.dir.name, METRICS_TOKEN='secret')
+        self.settings.enable()
+        process = subprocess.Popen(['true'])
+        process.wait()
+        self.dead_pid = process.pid
+
+    def tearDown(self):
+        self.settings.disable()
+        self.dir.cleanup()
+
+    def write(self, name, queries):
+        with open(os.path.join(self.dir.name, name), 'w') as f:
+            json.dump({DB_QUERIES.name: {json.dumps(['CourseViewSet', 'list']): queries}}, f)
+
+    def queries(self):
+        return registry.collect()[DB_QUERIES.name].get(json.dumps(['CourseViewSet', 'list']))
+
+    def test_exited_processes(self):
+        self.write(str(os.getpid()) + '-live.json', 2)
+        self.write(str(self.dead_pid) + '-old.json', 5)
+        self.assertEqual(self.queries(), 7)
+        self.assertFalse(os.path.exists(os.path.join(self.dir.name, str(self.dead_pid) + '-old.json')))
+        self.assertEqual(self.queries(), 7)
+        self.write(str(self.dead_pid) + '-new.json', 1)  # the pid was reused by another process, which exited too
+        self.assertEqual(self.queries(), 8)
+
+    def test_token(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+        response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'# TYPE ' + DB_QUERIES.name.encode() + b' counter', response.content)
+
+
+class QueueLoggingTest(TestCase):
+    """Records go through the listener thread as JSON lines carrying the request id and `extra` fields."""
+
+    def test_json_records(self):
+        stream = io.StringIO()
+        handler = QueueHandler(targets=[{'class': 'logging.StreamHandler', 'stream': stream, 'level': 'INFO'}])
+        handler.addFilter(RequestIdFilter())
+        logger = logging.getLogger('api.tests.queue')
+        logger.addHandler(handler)
+        logger.propagate = False
+        logger.setLevel(logging.DEBUG)
+        try:
+            set_request_id('req-1')
+            logger.info('sent %d of %d', 2, 3, extra={'notification': 7})
+            logger.debug('not written')
+            set_request_id(None)
+            try:
+                1 / 0
+            except ZeroDivisionError:
+                logger.exception('failed')
+        finally:
+            logger.removeHandler(handler)
+            handler.stop()
+        records = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual([r['message'] for r in records], ['sent 2 of 3', 'failed'])
+        self.assertEqual((records[0]['request_id'], records[0]['notification']), ('req-1', 7))
+        self.assertIsNone(records[1]['request_id'])
+        self.assertIn('ZeroDivisionError', records[1]['exception'])
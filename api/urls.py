@@ -23,7 +23,11 @@ router.register(r'meeting-proposal-results', MeetingProposalResultViewSet)
 router.register(r'course-messages', CourseMessageViewSet)
 router.register(r'group-messages', GroupMessageViewSet)
 router.register(r'server-status', ServerStateViewSet)
+router.register(r'sync', SyncViewSet, base_name='sync')
+router.register(r'batch', BatchViewSet, base_name='batch')
+router.register(r'export', ExportViewSet, base_name='export')
 router.register(r'devices/fcm', GCMDeviceAuthorizedViewSet)
+router.register(r'devices/stats', DeviceStatsViewSet, base_name='device-stats')
 urlpatterns = router.urls
 
 urlpatterns += [
@@ -1,16 +1,42 @@
+import calendar
+import hashlib
+import hmac
+import json
+import logging
+from io import BytesIO
+from timeit import default_timer as timer
+
 import django_filters
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist
+from django.core.handlers.wsgi import WSGIRequest
 from django.core.management import call_command
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.db import DatabaseError, connection, transaction
+from django.db.models import Case, Count, Exists, IntegerField, OuterRef, Prefetch, When
+from django.db.models.functions import TruncMonth
+from django.test.utils import CaptureQueriesContext
+from django.urls import Resolver404, resolve
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
 from django_filters.rest_framework import DjangoFilterBackend
 from django_filters import rest_framework as filters
 from rest_framework import status
 from rest_framework import filters as drf_filters
+from rest_framework import serializers
 from rest_framework.decorators import detail_route, list_route
-from rest_framework.permissions import BasePermission, IsAdminUser
+from rest_framework.permissions import SAFE_METHODS, BasePermission, IsAdminUser
 from rest_framework.response import Response
-from rest_framework.viewsets import ModelViewSet, ReadOnlyModelViewSet
+from rest_framework.viewsets import ModelViewSet, ReadOnlyModelViewSet, ViewSet
 
+from .db import is_pinned_to_primary, pin_to_primary, read_alias, use_replicas
+from .export import EXPORTS, FORMATS, export_lines
+from .membership import member_ids, membership
+from .metrics import CACHE_REQUESTS, registry
 from .serializers import *
 
+logger = logging.getLogger(__name__)
+
 
 # ~~~~~~~~ Permissions ~~~~~~~~ #
 
@@ -63,7 +89,7 @@ class MeetingFilter(filters.FilterSet):
     class Meta:
         model = Meeting
         fields = ('name', 'location', 'description', 'start_date', 'start_time', 'duration_minutes', 'course',
-                  'creator', 'members', 'start_date__lt', 'start_date__lte', 'start_date__gt', 'start_date__gte',
+                  'creator', 'members', 'retired', 'start_date__lt', 'start_date__lte', 'start_date__gt', 'start_date__gte',
                   'start_time__lt', 'start_time__lte', 'start_time__gt', 'start_time__gte')
 
 
@@ -89,20 +115,332 @@ class GroupMessageFilter(filters.FilterSet):
         fields = ('content', 'group', 'creator', 'timestamp', 'timestamp__lt', 'timestamp__lte', 'timestamp__gt', 'timestamp__gte')
 
 
+class ArchivedCourseMessageFilter(CourseMessageFilter):
+
+    class Meta(CourseMessageFilter.Meta):
+        model = ArchivedCourseMessage
+
+
+class ArchivedGroupMessageFilter(GroupMessageFilter):
+
+    class Meta(GroupMessageFilter.Meta):
+        model = ArchivedGroupMessage
+
+
 # ~~~~~~~~ Helper ~~~~~~~~ #
 
 
 def is_notification_recipient(notification, user):
-    for u in notification.recipients.all():
-        if u.pk == user.pk:
-            return True
-    return False
+    return notification.recipients.filter(pk=user.pk).exists()
+
+
+def sideload_users(rows):
+    user_ids = {row['creator'] for row in rows if row.get('creator')}
+    users = User.objects.filter(pk__in=user_ids).select_related('profile')
+    return {str(u['id']): u for u in UserSerializer(users, many=True).data}
+
+
+def request_cache(request):
+    """Dict for memoizing lookups for the rest of the request; the sub-requests of a batch share their parent's."""
+    http_request = getattr(request, '_request', request)
+    if not hasattr(http_request, 'api_cache'):
+        http_request.api_cache = {}
+    return http_request.api_cache
+
+
+def split_param(value):
+    return {v for v in value.split(',') if v} if value is not None else None
+
+
+def optimize_queryset(queryset, serializer, restrict_columns=False):
+    """Joins and prefetches exactly the relations the serializer's fields read.
+
+    With restrict_columns, the root query also selects only the columns those fields need (via only()).
+    """
+    only, select, prefetch = ['pk'], [], []
+    if not _collect_lookups(queryset.model, serializer.fields, '', only, select, prefetch):
+        restrict_columns = False  # some field reads a property or the whole object; keep every column
+    if restrict_columns:
+        queryset = queryset.only(*only)
+    if select:
+        queryset = queryset.select_related(*select)
+    return queryset.prefetch_related(*prefetch)
+
+
+def _collect_lookups(model, fields, prefix, only, select, prefetch):
+    mapped = True
+    for field in fields.values():
+        if field.source == '*' or '.' in field.source:
+            mapped = False
+            continue
+        try:
+            model_field = model._meta.get_field(field.source)
+        except FieldDoesNotExist:
+            mapped = False
+            continue
+        path = prefix + field.source
+        if model_field.many_to_many or model_field.one_to_many:
+            if isinstance(field, serializers.ManyRelatedField):  # ids only
+                columns = ('pk',) if model_field.many_to_many else ('pk', model_field.field.name)
+                prefetch.append(Prefetch(path, queryset=model_field.related_model.objects.only(*columns)))
+            else:
+                prefetch.append(path)
+        elif isinstance(field, serializers.BaseSerializer):  # nested object
+            select.append(path)
+            _collect_lookups(model_field.related_model, field.fields, path + '__', [], select, prefetch)
+        if model_field.concrete:
+            only.append(path)
+    return mapped
+
+
+# ~~~~~~~~ Mixins ~~~~~~~~ #
+
+
+class ReplicaReadMixin(object):
+    """Serves safe-method reads from a read replica, except right after the user wrote something.
+
+    Every safe-method action of a ReadOnlyModelViewSet goes to a replica; other viewsets only send list/retrieve.
+    """
+    replica_actions = ('list', 'retrieve', 'mine')
+
+    def initial(self, request, *args, **kwargs):
+        use_replicas(False)
+        super().initial(request, *args, **kwargs)
+        if getattr(request, 'batched', False):
+            return  # batch sub-requests run inside the batch's transaction on the primary
+        if request.method in SAFE_METHODS and (isinstance(self, ReadOnlyModelViewSet) or self.action in self.replica_actions):
+            use_replicas(not is_pinned_to_primary(request.user))
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        use_replicas(False)
+        if request.method not in SAFE_METHODS and request.user and request.user.is_authenticated():
+            pin_to_primary(request.user)
+        return super().finalize_response(request, response, *args, **kwargs)
+
+
+class SparseFieldsMixin(object):
+    """`?fields=a,b` limits the serialized fields and `?expand=x,y` picks which expandable relations stay nested.
+
+    On list/retrieve the queryset only selects, joins and prefetches what the resulting serializer reads. Both only apply
+    to safe methods: on writes they would drop the writable fields the serializer validates and saves.
+    """
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        if self.request is not None and self.request.method in SAFE_METHODS:
+            context['fields'] = split_param(self.request.query_params.get('fields'))
+            context['expand'] = split_param(self.request.query_params.get('expand'))
+        return context
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.action in ('list', 'retrieve', 'mine'):
+            serializer = self.get_serializer()
+            queryset = optimize_queryset(queryset, serializer, restrict_columns=serializer.context.get('fields') is not None)
+        return queryset
+
+
+class CompactUsersMixin(object):
+    """`?compact=true` on a list request replaces each row's nested creator with its id.
+
+    The distinct creators are serialized once and side-loaded as a `users` map (keyed by id) next to `results`.
+    """
+
+    def is_compact(self):
+        return self.action == 'list' and self.request is not None and self.request.query_params.get('compact') in ('1', 'true')
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context['compact'] = self.is_compact()
+        return context
+
+    def get_paginated_response(self, data):
+        response = super().get_paginated_response(data)
+        if self.is_compact():
+            response.data['users'] = sideload_users(data)
+        return response
+
+
+class FastListMixin(object):
+    """Serves plain list requests through `fast_serializer_class` when settings.FAST_LIST_SERIALIZERS is on.
+
+    Requests that reshape the output (`fields`, `expand`, `compact`) go through the regular serializer.
+    """
+    fast_serializer_class = None
+
+    def use_fast_list(self):
+        params = self.request.query_params
+        return settings.FAST_LIST_SERIALIZERS and not any(p in params for p in ('fields', 'expand', 'compact'))
+
+    def list(self, request, *args, **kwargs):
+        if not self.use_fast_list():
+            return super().list(request, *args, **kwargs)
+        fast = self.fast_serializer_class()
+        queryset = fast.prepare(self.filter_queryset(self.get_queryset()))
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(fast.serialize(page))
+        return Response(fast.serialize(queryset))
+
+
+class MineMixin(object):
+    """`mine` lists the objects the user is a member of, starting from their `membership` ids (see api.membership)."""
+    membership = None
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.action == 'mine':
+            queryset = queryset.filter(pk__in=member_ids(self.request.user, self.membership))
+        return queryset
+
+    @list_route()
+    def mine(self, request):
+        return self.list(request)
+
+
+class ActiveTermMixin(object):
+    """Lists (and `mine`) only cover rows of terms that haven't been retired (see Term.retire), through `active_filter`.
+
+    Filtering by one of `term_params` (the term, course or retired flag) lists retired rows too.
+    """
+    active_filter = {'retired': False}
+    term_params = ()
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.action in ('list', 'mine') and not any(p in self.request.query_params for p in self.term_params):
+            queryset = queryset.filter(**self.active_filter)
+        return queryset
+
+
+class BulkMembersMixin(object):
+    """`add-members`/`remove-members` take {"members": [user ids]} and change many memberships in one request.
+
+    The ids are checked against the course's members (and the current members) in one query, the through table is
+    written with one INSERT/DELETE, and the users added get one notification between them. Uses MineMixin's `membership`.
+    """
+    notification_class = None
+
+    @detail_route(methods=['post'], url_path='add-members')
+    def add_members(self, request, pk=None):
+        instance = self.get_object()
+        name = instance._meta.model_name
+        if not membership(request.user).has(self.membership, instance.pk):
+            return Response("Must be " + name + " member", status=status.HTTP_403_FORBIDDEN)
+        serializer = MemberIdsSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        user_ids = set(serializer.validated_data['members'])
+
+        members = type(instance).members.through.objects.filter(**{name + '_id': instance.pk, 'user_id': OuterRef('user_id')})
+        course_members = dict(Course.members.through.objects.filter(course_id=instance.course_id, user_id__in=user_ids)
+                              .annotate(is_member=Exists(members)).values_list('user_id', 'is_member'))
+        if len(course_members) != len(user_ids):
+            not_course_members = sorted(user_ids - set(course_members))
+            return Response("Must be course members: " + ', '.join(str(pk) for pk in not_course_members), status=status.HTTP_400_BAD_REQUEST)
+
+        added = [user_id for user_id, is_member in course_members.items() if not is_member]
+        if added:
+            instance.members.add(*added)
+            recipients = [user_id for user_id in added if user_id != request.user.pk]
+            if recipients:
+                notification = self.notification_class(message="%s has added you to their %s" % (request.user, name), creator=request.user, **{name: instance})
+                notification.save()
+                notification.recipients.add(*recipients)
+                transaction.on_commit(notification.broadcast)
+        return Response(self.get_serializer(instance).data)
+
+    @detail_route(methods=['post'], url_path='remove-members')
+    def remove_members(self, request, pk=None):
+        instance = self.get_object()
+        if request.user.pk != instance.creator_id:
+            return Response("Must be " + instance._meta.model_name + " creator", status=status.HTTP_403_FORBIDDEN)
+        serializer = MemberIdsSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        instance.members.remove(*serializer.validated_data['members'])
+        return Response(self.get_serializer(instance).data)
+
+
+class ArchiveMixin(object):
+    """Reads messages of archived terms (see Term.archive_messages) from `archive_model`, only when asked for them.
+
+    A list filtered by `archive_parent` (course or group) reads the archive table if that parent's term is archived, and
+    retrieve falls back to the archive for pks the hot table doesn't have. Unfiltered lists only cover the hot table.
+    """
+    archive_model = None
+    archive_filter_class = None
+    archive_parent = None
+    archive_term_lookup = None  # from the parent to its term
+
+    def get_queryset(self):
+        if getattr(self, 'read_archive', False) or (self.action == 'list' and self.parent_archived()):
+            self.filter_class = self.archive_filter_class
+            return self.archive_model.objects.all()
+        return super().get_queryset()
+
+    def get_object(self):
+        try:
+            return super().get_object()
+        except Http404:
+            if self.action != 'retrieve' or getattr(self, 'read_archive', False):
+                raise
+            self.read_archive = True
+            return super().get_object()
+
+    def parent_archived(self):
+        parent_id = self.request.query_params.get(self.archive_parent)
+        if not parent_id or not parent_id.isdigit():
+            return False
+        cache = request_cache(self.request)
+        key = ('archived', self.archive_parent, parent_id)
+        if key not in cache:
+            parent_model = self.archive_model._meta.get_field(self.archive_parent).related_model
+            cache[key] = parent_model.objects.filter(pk=parent_id, **{self.archive_term_lookup + '__messages_archived': True}).exists()
+        return cache[key]
+
+
+class ConditionalMixin(object):
+    """ETag and Last-Modified on list/retrieve, derived from the CollectionVersion stamps of `version_models`.
+
+    A matching If-None-Match is answered with 304 before the queryset or serializer runs, so `version_models` must cover
+    every model the response is built from. If-Modified-Since is not honored: Last-Modified has one-second resolution,
+    so it can't tell a response from a change made later in the same second, which the versions in the ETag can.
+    """
+    version_models = ()
+
+    def list(self, request, *args, **kwargs):
+        return self.conditional(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.conditional(super().retrieve, request, *args, **kwargs)
+
+    def conditional(self, action, request, *args, **kwargs):
+        cache = request_cache(request)
+        key = ('stamps',) + tuple(sorted(m._meta.label_lower for m in self.version_models))
+        if key not in cache:
+            cache[key] = CollectionVersion.stamps(self.version_models)
+        stamps = cache[key]
+        key = ','.join(name + ':' + str(version) for name, version, updated_at in stamps)
+        key += '|' + request.get_full_path() + '|' + request.META.get('HTTP_ACCEPT', '') + '|' + str(request.user.pk)
+        etag = '"' + hashlib.md5(key.encode()).hexdigest() + '"'
+        modified = [updated_at for name, version, updated_at in stamps if updated_at]
+        last_modified = calendar.timegm(max(modified).utctimetuple()) if modified else None
+
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = action(request, *args, **kwargs)
+        if 'HTTP_IF_NONE_MATCH' in request.META:
+            CACHE_REQUESTS.inc(cache='conditional', result='hit' if response.status_code == 304 else 'miss')
+        if response.status_code in (200, 304):
+            response['ETag'] = etag
+            if last_modified:
+                response['Last-Modified'] = http_date(last_modified)
+        return response
 
 
 # ~~~~~~~~ ViewSets ~~~~~~~~ #
 
 
-class UserViewSet(ModelViewSet):
+class UserViewSet(ReplicaReadMixin, SparseFieldsMixin, ModelViewSet):
     permission_classes = (IsAuthenticatedOrPOST, IsOwnerOrAdminUser)
     serializer_class = UserSerializer
     queryset = User.objects.all()
@@ -112,8 +450,9 @@ class UserViewSet(ModelViewSet):
     ordering_fields = '__all__'
 
 
-class TermViewSet(ReadOnlyModelViewSet):
+class TermViewSet(ReplicaReadMixin, FastListMixin, SparseFieldsMixin, ReadOnlyModelViewSet):
     serializer_class = TermSerializer
+    fast_serializer_class = TermFastSerializer
     queryset = Term.objects.all()
     ordering = ('-code',)
     search_fields = ('name',)
@@ -125,21 +464,27 @@ class TermViewSet(ReadOnlyModelViewSet):
         return Response(self.get_serializer(Term.get_current()).data)
 
 
-class SubjectViewSet(ReadOnlyModelViewSet):
+class SubjectViewSet(ReplicaReadMixin, FastListMixin, ActiveTermMixin, SparseFieldsMixin, ReadOnlyModelViewSet):
     serializer_class = SubjectSerializer
+    fast_serializer_class = SubjectFastSerializer
+    active_filter = {'term__retired': False}
+    term_params = ('term', 'term__name', 'term__code', 'term__retired')
     queryset = Subject.objects.all()
     ordering = ('-term__code', 'code')
     search_fields = ('code', 'name')
-    filter_fields = ('name', 'code', 'term', 'term__name', 'term__code', 'courses_loaded')
+    filter_fields = ('name', 'code', 'term', 'term__name', 'term__code', 'term__retired', 'courses_loaded')
     ordering_fields = '__all__'
 
 
-class CourseViewSet(ReadOnlyModelViewSet):
+class CourseViewSet(ReplicaReadMixin, FastListMixin, MineMixin, ActiveTermMixin, SparseFieldsMixin, ReadOnlyModelViewSet):
     serializer_class = CourseSerializer
+    membership = 'courses'
+    term_params = ('subject', 'subject__term', 'subject__term__name', 'subject__term__code', 'retired')
+    fast_serializer_class = CourseFastSerializer
     queryset = Course.objects.all()
     ordering = ('subject__code', 'course_number')
     search_fields = ('subject__code', 'course_number', 'subject__name', 'name')  # TODO: remove name and subject__name for performance?
-    filter_fields = ('name', 'subject', 'subject__code', 'subject__term', 'subject__term__name', 'subject__term__code', 'course_number', 'members', 'is_cancelled')  # TODO: make subject__code case-insensitive?
+    filter_fields = ('name', 'subject', 'subject__code', 'subject__term', 'subject__term__name', 'subject__term__code', 'course_number', 'members', 'is_cancelled', 'retired')  # TODO: make subject__code case-insensitive?
     ordering_fields = '__all__'
 
     @detail_route(methods=['post'])
@@ -155,8 +500,12 @@ class CourseViewSet(ReadOnlyModelViewSet):
         return Response(self.get_serializer(instance).data)
 
 
-class GroupViewSet(ModelViewSet):
+class GroupViewSet(ReplicaReadMixin, ConditionalMixin, MineMixin, BulkMembersMixin, ActiveTermMixin, SparseFieldsMixin, CompactUsersMixin, ModelViewSet):
     serializer_class = GroupSerializer
+    membership = 'groups'
+    term_params = ('course', 'retired')
+    notification_class = GroupNotification
+    version_models = (Group, User)
     queryset = Group.objects.all()
     ordering = ('course', 'name', 'pk')
     search_fields = ('name', 'creator__first_name', 'creator__last_name', 'members__first_name', 'members__last_name')
@@ -165,14 +514,14 @@ class GroupViewSet(ModelViewSet):
 
     def destroy(self, request, *args, **kwargs):
         instance = self.get_object()
-        if request.user.pk != instance.creator.pk:
+        if request.user.pk != instance.creator_id:
             return Response("Must be group creator", status=status.HTTP_403_FORBIDDEN)
         return super(GroupViewSet, self).destroy(request, *args, **kwargs)
 
     @detail_route(methods=['post'])
     def join(self, request, pk=None):
         instance = self.get_object()
-        if not request.user.courses_as_member.filter(pk=instance.course.pk):
+        if not membership(request.user).has('courses', instance.course_id):
             return Response("Must be course member", status=status.HTTP_403_FORBIDDEN)
         instance.members.add(request.user)
         return Response(self.get_serializer(instance).data)
@@ -184,8 +533,12 @@ class GroupViewSet(ModelViewSet):
         return Response(self.get_serializer(instance).data)
 
 
-class MeetingViewSet(ModelViewSet):
+class MeetingViewSet(ReplicaReadMixin, ConditionalMixin, MineMixin, BulkMembersMixin, ActiveTermMixin, SparseFieldsMixin, CompactUsersMixin, ModelViewSet):
     serializer_class = MeetingSerializer
+    membership = 'meetings'
+    term_params = ('course', 'retired')
+    notification_class = MeetingNotification
+    version_models = (Meeting, User)
     queryset = Meeting.objects.all()
     ordering = ('course', '-start_date', '-start_time', '-duration_minutes', 'name', 'pk')
     search_fields = ('name', 'description', 'location', 'creator__first_name', 'creator__last_name', 'members__first_name', 'members__last_name')
@@ -194,14 +547,14 @@ class MeetingViewSet(ModelViewSet):
 
     def destroy(self, request, *args, **kwargs):
         instance = self.get_object()
-        if request.user.pk != instance.creator.pk:
+        if request.user.pk != instance.creator_id:
             return Response("Must be meeting creator", status=status.HTTP_403_FORBIDDEN)
         return super(MeetingViewSet, self).destroy(request, *args, **kwargs)
 
     @detail_route(methods=['post'])
     def join(self, request, pk=None):
         instance = self.get_object()
-        if not request.user.courses_as_member.filter(pk=instance.course.pk):
+        if not membership(request.user).has('courses', instance.course_id):
             return Response("Must be course member", status=status.HTTP_403_FORBIDDEN)
         instance.members.add(request.user)
         return Response(self.get_serializer(instance).data)
@@ -213,8 +566,9 @@ class MeetingViewSet(ModelViewSet):
         return Response(self.get_serializer(instance).data)
 
 
-class StandardNotificationViewSet(ModelViewSet):
+class StandardNotificationViewSet(ReplicaReadMixin, ConditionalMixin, SparseFieldsMixin, CompactUsersMixin, ModelViewSet):
     serializer_class = StandardNotificationSerializer
+    version_models = (Notification, User)
     queryset = StandardNotification.objects.all()
     ordering = ('-pk',)
     search_fields = ()  # TODO
@@ -230,8 +584,9 @@ class StandardNotificationViewSet(ModelViewSet):
         return Response(self.get_serializer(instance).data)
 
 
-class GroupNotificationViewSet(ModelViewSet):
+class GroupNotificationViewSet(ReplicaReadMixin, ConditionalMixin, SparseFieldsMixin, CompactUsersMixin, ModelViewSet):
     serializer_class = GroupNotificationSerializer
+    version_models = (Notification, User)
     queryset = GroupNotification.objects.all()
     ordering = ('-pk',)
     search_fields = ()  # TODO
@@ -247,8 +602,9 @@ class GroupNotificationViewSet(ModelViewSet):
         return Response(self.get_serializer(instance).data)
 
 
-class MeetingNotificationViewSet(ModelViewSet):
+class MeetingNotificationViewSet(ReplicaReadMixin, ConditionalMixin, SparseFieldsMixin, CompactUsersMixin, ModelViewSet):
     serializer_class = MeetingNotificationSerializer
+    version_models = (Notification, User)
     queryset = MeetingNotification.objects.all()
     ordering = ('-pk',)
     search_fields = ()  # TODO
@@ -264,8 +620,9 @@ class MeetingNotificationViewSet(ModelViewSet):
         return Response(self.get_serializer(instance).data)
 
 
-class GroupInvitationViewSet(ModelViewSet):
+class GroupInvitationViewSet(ReplicaReadMixin, ConditionalMixin, SparseFieldsMixin, CompactUsersMixin, ModelViewSet):
     serializer_class = GroupInvitationSerializer
+    version_models = (Notification, User)
     queryset = GroupInvitation.objects.all()
     ordering = ('-pk',)
     search_fields = ()  # TODO
@@ -281,8 +638,9 @@ class GroupInvitationViewSet(ModelViewSet):
         return Response(self.get_serializer(instance).data)
 
 
-class MeetingInvitationViewSet(ModelViewSet):
+class MeetingInvitationViewSet(ReplicaReadMixin, ConditionalMixin, SparseFieldsMixin, CompactUsersMixin, ModelViewSet):
     serializer_class = MeetingInvitationSerializer
+    version_models = (Notification, User)
     queryset = MeetingInvitation.objects.all()
     ordering = ('-pk',)
     search_fields = ()  # TODO
@@ -298,8 +656,9 @@ class MeetingInvitationViewSet(ModelViewSet):
         return Response(self.get_serializer(instance).data)
 
 
-class MeetingProposalViewSet(ModelViewSet):
+class MeetingProposalViewSet(ReplicaReadMixin, ConditionalMixin, SparseFieldsMixin, CompactUsersMixin, ModelViewSet):
     serializer_class = MeetingProposalSerializer
+    version_models = (Notification, User)
     queryset = MeetingProposal.objects.all()
     ordering = ('meeting__course', 'meeting', '-pk')
     search_fields = ()  # TODO
@@ -331,8 +690,9 @@ class MeetingProposalViewSet(ModelViewSet):
         return Response(self.get_serializer(instance).data)
 
 
-class MeetingProposalResultViewSet(ReadOnlyModelViewSet):
+class MeetingProposalResultViewSet(ReplicaReadMixin, ConditionalMixin, SparseFieldsMixin, CompactUsersMixin, ReadOnlyModelViewSet):
     serializer_class = MeetingProposalResultSerializer
+    version_models = (Notification, User)
     queryset = MeetingProposalResult.objects.all()
     ordering = ('meeting__course', 'meeting', '-pk')
     search_fields = ()  # TODO
@@ -348,8 +708,13 @@ class MeetingProposalResultViewSet(ReadOnlyModelViewSet):
         return Response(self.get_serializer(instance).data)
 
 
-class CourseMessageViewSet(ModelViewSet):
+class CourseMessageViewSet(ReplicaReadMixin, FastListMixin, SparseFieldsMixin, CompactUsersMixin, ArchiveMixin, ModelViewSet):
     serializer_class = CourseMessageSerializer
+    fast_serializer_class = CourseMessageFastSerializer
+    archive_model = ArchivedCourseMessage
+    archive_filter_class = ArchivedCourseMessageFilter
+    archive_parent = 'course'
+    archive_term_lookup = 'subject__term'
     queryset = CourseMessage.objects.all()
     ordering = ('course', '-pk')
     search_fields = ('content', 'creator__first_name', 'creator__last_name')
@@ -357,8 +722,13 @@ class CourseMessageViewSet(ModelViewSet):
     ordering_fields = '__all__'
 
 
-class GroupMessageViewSet(ModelViewSet):
+class GroupMessageViewSet(ReplicaReadMixin, FastListMixin, SparseFieldsMixin, CompactUsersMixin, ArchiveMixin, ModelViewSet):
     serializer_class = GroupMessageSerializer
+    fast_serializer_class = GroupMessageFastSerializer
+    archive_model = ArchivedGroupMessage
+    archive_filter_class = ArchivedGroupMessageFilter
+    archive_parent = 'group'
+    archive_term_lookup = 'course__subject__term'
     queryset = GroupMessage.objects.all()
     ordering = ('group__course', 'group', '-pk')
     search_fields = ('content', 'creator__first_name', 'creator__last_name')
@@ -366,7 +736,7 @@ class GroupMessageViewSet(ModelViewSet):
     ordering_fields = '__all__'
 
 
-class ServerStateViewSet(ReadOnlyModelViewSet):
+class ServerStateViewSet(ReplicaReadMixin, SparseFieldsMixin, ReadOnlyModelViewSet):
     serializer_class = ServerStateSerializer
     queryset = ServerState.objects.all()
 
@@ -380,3 +750,202 @@ class ServerStateViewSet(ReadOnlyModelViewSet):
     # @list_route(methods=['post'], permission_classes=[IsAdminUser])
     # def populate_data(self, request):
     #     call_command('populate_data')
+
+
+SYNC_SERIALIZERS = {
+    'api.group': ('groups', GroupSerializer),
+    'api.meeting': ('meetings', MeetingSerializer),
+    'api.coursemessage': ('course_messages', CourseMessageSerializer),
+    'api.groupmessage': ('group_messages', GroupMessageSerializer),
+}
+SYNC_NOTIFICATION_SERIALIZERS = (  # most derived first; each notification is reported under its own type
+    ('group_invitations', GroupInvitationSerializer),
+    ('meeting_invitations', MeetingInvitationSerializer),
+    ('meeting_proposals', MeetingProposalSerializer),
+    ('meeting_proposal_results', MeetingProposalResultSerializer),
+    ('group_notifications', GroupNotificationSerializer),
+    ('meeting_notifications', MeetingNotificationSerializer),
+    ('standard_notifications', StandardNotificationSerializer),
+)
+
+
+class SyncViewSet(ViewSet):
+    """`?since=<token>` returns the groups, meetings, messages and notifications of the user's courses and groups that
+    were created, updated (`changed`) or deleted (`deleted`, ids only) since the token, plus the token to use next.
+
+    Without a token, or with one older than the tombstone horizon, the response has `reset: true` and the client should
+    refetch its lists. `more: true` means another batch is waiting. Recent changes are sent again on the next sync until
+    they are older than SYNC_SETTLE_SECONDS, so clients must apply them idempotently.
+    """
+
+    def list(self, request):
+        since = request.query_params.get('since')
+        if since is not None and not since.isdigit():
+            return Response("Invalid since token", status=status.HTTP_400_BAD_REQUEST)
+        settled = ChangeLogEntry.settled_seq()
+        if since is None or int(since) < SyncState.load().horizon:
+            return Response({'token': str(settled), 'reset': True, 'more': False, 'changed': {}, 'deleted': {}})
+
+        since = int(since)
+        entries = list(ChangeLogEntry.visible_to(request.user).filter(seq__gt=since)
+                       .values_list('seq', 'collection', 'object_id', 'deleted')[:settings.SYNC_BATCH_SIZE])
+        more = len(entries) == settings.SYNC_BATCH_SIZE
+        token = max(since, min(entries[-1][0], settled) if more else settled)
+
+        changed_ids, deleted_ids = {}, {}
+        latest = {(collection, object_id): deleted for seq, collection, object_id, deleted in entries}
+        for (collection, object_id), deleted in latest.items():
+            (deleted_ids if deleted else changed_ids).setdefault(collection, set()).add(object_id)
+
+        changed, deleted = {}, {}
+        context = {'request': request, 'view': self}
+        for collection, (key, serializer_class) in SYNC_SERIALIZERS.items():
+            ids = changed_ids.get(collection, set())
+            rows = self.serialize(serializer_class, ids, context) if ids else []
+            gone = deleted_ids.get(collection, set()) | (ids - {row['id'] for row in rows})
+            if rows:
+                changed[key] = rows
+            if gone:
+                deleted[key] = sorted(gone)
+
+        ids = changed_ids.get('api.notification', set())
+        for key, serializer_class in SYNC_NOTIFICATION_SERIALIZERS:
+            rows = self.serialize(serializer_class, ids, context) if ids else []
+            if rows:
+                changed[key] = rows
+                ids = ids - {row['id'] for row in rows}
+        gone = deleted_ids.get('api.notification', set()) | ids
+        if gone:
+            deleted['notifications'] = sorted(gone)
+
+        return Response({'token': str(token), 'reset': False, 'more': more and token > since, 'changed': changed, 'deleted': deleted})
+
+    def serialize(self, serializer_class, ids, context):
+        serializer = serializer_class(context=context)
+        queryset = optimize_queryset(serializer.Meta.model.objects.filter(pk__in=ids), serializer)
+        return serializer_class(queryset, many=True, context=context).data
+
+
+class BatchViewSet(ViewSet):
+    """POST a list of sub-requests (`method`, `url`, optional `body` and `headers`) to run them in one transaction.
+
+    The sub-requests reuse this request's authentication and request cache and skip the middleware. Each result has the
+    sub-request's `status`, `data`, `etag` and a `time_ms`/`queries` breakdown. Each sub-request runs in a savepoint,
+    and a database error becomes a 500 result for that sub-request. If a batch containing writes has a failing
+    sub-request, the whole batch is rolled back; push notifications are only sent once it commits (on_commit).
+    """
+
+    def create(self, request):
+        subrequests = request.data
+        if not isinstance(subrequests, list) or not all(isinstance(s, dict) and s.get('url') for s in subrequests):
+            return Response("Expected a list of {method, url, body, headers} objects", status=status.HTTP_400_BAD_REQUEST)
+        if len(subrequests) > settings.BATCH_MAX_REQUESTS:
+            return Response("At most " + str(settings.BATCH_MAX_REQUESTS) + " sub-requests", status=status.HTTP_400_BAD_REQUEST)
+
+        read_only = all(s.get('method', 'GET').upper() in SAFE_METHODS for s in subrequests)
+        start_timer = timer()
+        with transaction.atomic():
+            if read_only and connection.vendor == 'postgresql':
+                connection.cursor().execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY')  # one snapshot
+            results = [self.run(request, s) for s in subrequests]
+            rolled_back = not read_only and any(r['status'] >= 400 for r in results)
+            if rolled_back:
+                transaction.set_rollback(True)
+        end_timer = timer()
+        return Response({'results': results, 'rolled_back': rolled_back, 'time_ms': round((end_timer - start_timer) * 1000, 2)})
+
+    def run(self, request, subrequest):
+        method = subrequest.get('method', 'GET').upper()
+        path, _, query = subrequest['url'].partition('?')
+        body = json.dumps(subrequest['body']).encode() if subrequest.get('body') is not None else b''
+        result = {'method': method, 'url': subrequest['url']}
+        try:
+            match = resolve(path)
+        except Resolver404:
+            match = None
+        if match is None or getattr(match.func, 'cls', None) in (None, BatchViewSet):
+            result.update(status=status.HTTP_404_NOT_FOUND, data=None, etag=None, time_ms=0, queries=0)
+            return result
+
+        environ = {k: v for k, v in request.META.items() if not k.startswith('HTTP_IF_')}
+        environ.update({'REQUEST_METHOD': method, 'PATH_INFO': path, 'QUERY_STRING': query, 'wsgi.input': BytesIO(body),
+                        'CONTENT_TYPE': 'application/json', 'CONTENT_LENGTH': str(len(body))})
+        for name, value in (subrequest.get('headers') or {}).items():
+            environ['HTTP_' + name.upper().replace('-', '_')] = str(value)
+        sub = WSGIRequest(environ)
+        sub.user = request.user
+        sub._force_auth_user, sub._force_auth_token = request.user, request.auth  # DRF skips authentication
+        sub.api_cache = request_cache(request)
+        sub.batched = True
+
+        start_timer = timer()
+        with CaptureQueriesContext(connection) as queries:
+            try:
+                with transaction.atomic():  # a savepoint, so a database error leaves the batch's transaction usable
+                    response = match.func(sub, *match.args, **match.kwargs)
+            except DatabaseError:
+                logger.exception('batch: %s %s failed', method, subrequest['url'])
+                response = Response("Database error", status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        end_timer = timer()
+        result.update(status=response.status_code, data=getattr(response, 'data', None), etag=response.get('ETag'),
+                      time_ms=round((end_timer - start_timer) * 1000, 2), queries=len(queries))
+        return result
+
+
+class DeviceStatsViewSet(ViewSet):
+    permission_classes = (IsAdminUser,)
+
+    def list(self, request):
+        """Active/inactive push device counts per user cohort (month the user joined)."""
+        rows = (GCMDevice.objects
+                .annotate(cohort=TruncMonth('user__date_joined'))
+                .values('cohort')
+                .annotate(active_count=Count(Case(When(active=True, then=1), output_field=IntegerField())),
+                          inactive_count=Count(Case(When(active=False, then=1), output_field=IntegerField())))
+                .order_by('cohort'))
+        stats = []
+        for row in rows:
+            total = row['active_count'] + row['inactive_count']
+            stats.append({
+                'cohort': row['cohort'].strftime('%Y-%m') if row['cohort'] else None,
+                'active': row['active_count'],
+                'inactive': row['inactive_count'],
+                'active_ratio': row['active_count'] / total if total else None,
+            })
+        return Response(stats)
+
+
+class ExportViewSet(ViewSet):
+    """Whole tables as NDJSON (default) or CSV for analytics: `/api/export/<name>/?output=csv`.
+
+    The response is streamed in chunks of EXPORT_CHUNK_SIZE rows read from a replica (see api.export), so memory use
+    doesn't grow with the table. `manage.py export_data` writes the same output to a file.
+    """
+    permission_classes = (IsAdminUser,)
+
+    def list(self, request):
+        return Response({'exports': list(EXPORTS), 'outputs': sorted(FORMATS)})
+
+    def retrieve(self, request, pk=None):
+        output_format = request.query_params.get('output', 'ndjson')
+        if pk not in EXPORTS:
+            return Response("Unknown export", status=status.HTTP_404_NOT_FOUND)
+        if output_format not in FORMATS:
+            return Response("Output must be one of: " + ', '.join(sorted(FORMATS)), status=status.HTTP_400_BAD_REQUEST)
+        response = StreamingHttpResponse(export_lines(pk, output_format, using=read_alias()), content_type=FORMATS[output_format])
+        response['Content-Disposition'] = 'attachment; filename="' + pk + '.' + output_format + '"'
+        return response
+
+
+# ~~~~~~~~ Metrics ~~~~~~~~ #
+
+
+def metrics(request):
+    """Prometheus scrape endpoint (/metrics): the api.metrics of every process, for `Authorization: Bearer
+    <METRICS_TOKEN>` or a staff session.
+    """
+    token = settings.METRICS_TOKEN
+    authorization = request.META.get('HTTP_AUTHORIZATION', '')
+    if not (token and hmac.compare_digest(authorization.encode(), ('Bearer ' + token).encode()) or request.user.is_staff):
+        return HttpResponse('Forbidden', status=status.HTTP_403_FORBIDDEN, content_type='text/plain')
+    return HttpResponse(registry.exposition(), content_type='text/plain; version=0.0.4; charset=utf-8')
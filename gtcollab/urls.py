@@ -17,11 +17,13 @@ from django.conf.urls import url, include
 from django.conf.urls.static import static
 from django.contrib import admin
 
+from api.views import metrics
 from gtcollab import settings
 
 urlpatterns = [
     url(r'^admin/', admin.site.urls),
     url(r'^api/', include('api.urls')),
+    url(r'^metrics$', metrics),
 ]
 
 if settings.DEBUG: